@@ -1,32 +1,109 @@
+import asyncio
+import atexit
 import logging
-import queue
+import os
 import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
 
+from dynoscale.aggregator import QueueTimeAggregator
+from dynoscale.buffer import RingBuffer
 from dynoscale.config import Config
 from dynoscale.publisher import DynoscalePublisher
 from dynoscale.repository import Record
+from dynoscale.utils import epoch_s
 
 RECORD_SOURCE = "web"
 RECORD_METADATA = ""
+LOG_BATCH_SIZE = 1_000  # Maximum number of records stored in a single transaction
+AGGREGATE_FLUSH_INTERVAL = 1.0  # How often closed per-second buckets are stored when aggregating
+AGGREGATE_FLUSH_DELAY = 1  # Seconds a bucket is kept open after its second is over, for records still in flight
+MIN_WAKEUP_INTERVAL = 0.1  # Shortest wait between ticks, so a publish that keeps failing early can't spin the thread
+SHUTDOWN_TIMEOUT = 5.0  # Maximum time spent storing and publishing the remaining records when the process exits
 
 logger = logging.getLogger(__name__)
-request_log_queue = queue.Queue()
 
+_fork_generation = 0  # Incremented in the child after every fork, agents compare it to notice they were forked
+_forkable_agents = weakref.WeakSet()  # DynoscaleAgents whose locks are replaced in a forked child
 
-def queue_time_logger(enable_rq_logger: bool):
-    logger.debug("queue_time_logger")
-    publisher = DynoscalePublisher()
+
+def _after_fork_in_child():
+    """Counts the fork and replaces the locks, another thread of the parent may have held them while forking"""
+    global _fork_generation, _agents_lock
+    _fork_generation += 1
+    _agents_lock = threading.Lock()
+    for agent in _forkable_agents:
+        agent._start_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def create_publisher(enable_rq_logger: bool, config: Optional[Config] = None) -> DynoscalePublisher:
+    """Creates the publisher, with the agent's config so it opens the repository the agent was configured with"""
+    publisher = DynoscalePublisher(config)
     if enable_rq_logger:
         from dynoscale.workers.rq_logger import DynoscaleRqLogger
-        rq_logger = DynoscaleRqLogger()
+        rq_logger = DynoscaleRqLogger(repository=publisher.repository)
         publisher.pre_publish_hook = rq_logger.log_queue_times
+    return publisher
+
+
+def store_records(publisher: DynoscalePublisher, records: List[Record]):
+    """Stores records in the publisher's repository and lets it publish if it's time to"""
+    if records:
+        publisher.repository.add_records(records)
+        logger.info("Logged %s queue time records, the last one at %s.", len(records), records[-1].timestamp)
+    publisher.tick()
+
+
+def next_wakeup(publisher: DynoscalePublisher, aggregate: bool) -> float:
+    """Seconds the logger may wait for records before it has to tick the publisher or flush aggregated buckets"""
+    timeout = publisher.seconds_until_publish()
+    if aggregate:
+        timeout = min(timeout, AGGREGATE_FLUSH_INTERVAL)
+    return max(timeout, MIN_WAKEUP_INTERVAL)
+
 
+def publish_remaining(publisher: DynoscalePublisher):
+    """Last attempt to publish whatever is stored before the process exits, regardless of the publish frequency"""
+    try:
+        logger.info("Publishing remaining records before shutdown.")
+        publisher.publish()
+    except Exception as e:
+        logger.error(f"Dynoscale couldn't publish remaining records before shutdown: {e}")
+
+
+def queue_time_logger(
+        enable_rq_logger: bool,
+        buffer: RingBuffer,
+        aggregate: bool = False,
+        config: Optional[Config] = None
+):
+    logger.debug("queue_time_logger")
+    publisher = create_publisher(enable_rq_logger, config)
+
+    aggregator = QueueTimeAggregator() if aggregate else None
+    reported_dropped = 0
     while True:
-        record: Record = request_log_queue.get(block=True, timeout=None)
-        logger.debug(f"queue_time_logger - got record from queue: {record}")
-        publisher.repository.add_record(record)
-        logger.info(f"Queue time {record.metric}ms logged at {record.timestamp}.")
-        publisher.tick()
+        # wakes up in time to publish (and poll RQ queues) even when no requests arrive
+        records: List[Record] = buffer.drain(LOG_BATCH_SIZE, timeout=next_wakeup(publisher, aggregate))
+        logger.debug("queue_time_logger - got %s records from buffer", len(records))
+        if buffer.dropped != reported_dropped:
+            reported_dropped = buffer.dropped
+            logger.warning(f"Log buffer is full, {reported_dropped} records were dropped so far.")
+        stopping = buffer.closed and not records
+        if aggregator is not None:
+            for record in records:
+                aggregator.add(record)
+            records = aggregator.flush(before=None if stopping else epoch_s() - AGGREGATE_FLUSH_DELAY)
+        if stopping:
+            if records:
+                publisher.repository.add_records(records)
+            publish_remaining(publisher)
+            return
+        store_records(publisher, records)
 
 
 class DynoscaleAgent:
@@ -35,29 +112,188 @@ class DynoscaleAgent:
         self.logger: logging.Logger = logging.getLogger(f"{__name__}.{DynoscaleAgent.__name__}")
         self.logger.debug("__init__")
         self.config = Config()
+        self._start_lock: threading.Lock = threading.Lock()
+        self.buffer = RingBuffer(self.config.buffer_capacity, self.config.buffer_overflow_policy)
+        self.fork_generation: int = _fork_generation
+        _forkable_agents.add(self)
         if self.config.is_valid:
-            self.t_logger = threading.Thread(
-                target=queue_time_logger,
-                daemon=True,
-                kwargs={
-                    'enable_rq_logger': self.config.is_rq_available,
-                },
-                name='Dynoscale'
-            )
-            self.t_logger.start()
-            self.logger.info(f"Logging thread '{self.t_logger.name}' started.")
+            self._start_logger()
+            atexit.register(self.shutdown)
         else:
             self.logger.warning(
                 f"{DynoscaleAgent.__name__} will not start Dynoscale logger thread with invalid config: {self.config}."
             )
 
+    def _start_logger(self):
+        self.t_logger = threading.Thread(
+            target=queue_time_logger,
+            daemon=True,
+            kwargs={
+                'enable_rq_logger': self.config.is_rq_available,
+                'buffer': self.buffer,
+                'aggregate': self.config.is_aggregating,
+                'config': self.config,
+            },
+            name='Dynoscale'
+        )
+        self.t_logger.start()
+        self.logger.info(f"Logging thread '{self.t_logger.name}' started.")
+
+    def _restart_after_fork(self):
+        """Gives a forked process its own buffer and logger thread, the inherited thread doesn't run in the child and
+        the publisher's repository connection and HTTP session belong to the parent."""
+        with self._start_lock:
+            if self.fork_generation == _fork_generation:
+                return  # another request thread restarted it already
+            self.logger.info(f"Restarting logging thread in forked process {os.getpid()}.")
+            self.buffer = RingBuffer(self.config.buffer_capacity, self.config.buffer_overflow_policy)
+            self._start_logger()
+            self.fork_generation = _fork_generation
+
+    def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Stores the buffered records and tries to publish them, waits at most timeout seconds for it to finish"""
+        t_logger = getattr(self, 't_logger', None)
+        if t_logger is None or not t_logger.is_alive() or self.fork_generation != _fork_generation:
+            return
+        self.logger.info("Shutting down logging thread.")
+        self.buffer.close()
+        t_logger.join(timeout)
+        if t_logger.is_alive():
+            self.logger.warning(f"Logging thread didn't finish within {timeout}s, remaining records may be lost.")
+
     def log_queue_time(self, timestamp: int, queue_time: int):
-        self.logger.debug(f"log_queue_time - {timestamp} {queue_time}")
+        self.logger.debug("log_queue_time - %s %s", timestamp, queue_time)
         if self.config.is_valid:
-            record = Record(timestamp, queue_time, RECORD_SOURCE, RECORD_METADATA)
-            try:
-                request_log_queue.put(record, timeout=0.25)
-            except queue.Full:
-                self.logger.error(f"Log queue is full, record {record} won't be logged!")
+            if self.fork_generation != _fork_generation:
+                self._restart_after_fork()
+            # never blocks, if the buffer is full the logger thread reports the dropped records
+            self.buffer.put(Record(timestamp, queue_time, RECORD_SOURCE, RECORD_METADATA))
         else:
-            self.logger.info(f"Throwing away queue time due to invalid config: {self.config}")
+            self.logger.info("Throwing away queue time due to invalid config: %s", self.config)
+
+
+class AsyncDynoscaleAgent:
+    """DynoscaleAgent for asyncio servers, drains and publishes records from a task on the server's event loop.
+
+    The task is started by DynoscaleAsgiApp on lifespan startup, or by the first queue time logged from a running loop
+    on servers without lifespan. Logging a queue time only puts a record
+    into the buffer, the SQLite writes and uploads run in a single executor thread, so the loop never blocks on them.
+    """
+
+    def __init__(self):
+        self.logger: logging.Logger = logging.getLogger(f"{__name__}.{AsyncDynoscaleAgent.__name__}")
+        self.logger.debug("__init__")
+        self.config = Config()
+        self.buffer = RingBuffer(self.config.buffer_capacity, self.config.buffer_overflow_policy)
+        self.task: Optional[asyncio.Task] = None
+        self._has_records: Optional[asyncio.Event] = None
+        if self.config.is_not_valid:
+            self.logger.warning(
+                f"{AsyncDynoscaleAgent.__name__} will not start Dynoscale logger task with invalid config: "
+                f"{self.config}."
+            )
+
+    def start(self):
+        """Starts the logging task on the running event loop, unless it already runs there"""
+        loop = asyncio.get_running_loop()
+        if self.config.is_not_valid:
+            return
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self._start_logger(loop)
+
+    def _start_logger(self, loop: asyncio.AbstractEventLoop):
+        self._has_records = asyncio.Event()
+        self.task = loop.create_task(self.queue_time_logger(), name='Dynoscale')
+        self.logger.info(f"Logging task '{self.task.get_name()}' started.")
+
+    async def queue_time_logger(self):
+        self.logger.debug("queue_time_logger")
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Dynoscale')
+        try:
+            # the publisher's SQLite connection may only be used by the thread that created it
+            publisher = await loop.run_in_executor(
+                executor, create_publisher, self.config.is_rq_available, self.config
+            )
+            aggregator = QueueTimeAggregator() if self.config.is_aggregating else None
+            reported_dropped = 0
+            while True:
+                try:
+                    await asyncio.wait_for(
+                        self._has_records.wait(), next_wakeup(publisher, self.config.is_aggregating)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                self._has_records.clear()
+                records: List[Record] = self.buffer.drain(self.buffer.capacity, timeout=0)
+                if self.buffer.dropped != reported_dropped:
+                    reported_dropped = self.buffer.dropped
+                    self.logger.warning(f"Log buffer is full, {reported_dropped} records were dropped so far.")
+                stopping = self.buffer.closed
+                if aggregator is not None:
+                    for record in records:
+                        aggregator.add(record)
+                    records = aggregator.flush(before=None if stopping else epoch_s() - AGGREGATE_FLUSH_DELAY)
+                if stopping:
+                    if records:
+                        await loop.run_in_executor(executor, publisher.repository.add_records, records)
+                    await loop.run_in_executor(executor, publish_remaining, publisher)
+                    return
+                for start in range(0, len(records), LOG_BATCH_SIZE):
+                    await loop.run_in_executor(executor, store_records, publisher, records[start:start + LOG_BATCH_SIZE])
+                if not records:
+                    await loop.run_in_executor(executor, publisher.tick)
+        except Exception as e:
+            self.logger.error(f"Logging task stopped by an unexpected error, it restarts with the next record: {e}")
+        finally:
+            executor.shutdown(wait=False)
+
+    async def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Stores the buffered records and tries to publish them, waits at most timeout seconds for it to finish"""
+        task = self.task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            return
+        self.logger.info("Shutting down logging task.")
+        self.buffer.close()
+        self._has_records.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Logging task didn't finish within {timeout}s, remaining records may be lost.")
+
+    def log_queue_time(self, timestamp: int, queue_time: int):
+        self.logger.debug("log_queue_time - %s %s", timestamp, queue_time)
+        if self.config.is_not_valid:
+            self.logger.info("Throwing away queue time due to invalid config: %s", self.config)
+            return
+        # never blocks, if the buffer is full the logger task reports the dropped records
+        self.buffer.put(Record(timestamp, queue_time, RECORD_SOURCE, RECORD_METADATA))
+        try:
+            self.start()
+        except RuntimeError:
+            self.logger.warning("Can't start logging task without a running event loop, the record stays buffered.")
+            return
+        if not self._has_records.is_set():
+            self._has_records.set()
+
+
+_agents: Dict[bool, Union[DynoscaleAgent, AsyncDynoscaleAgent]] = {}  # The process wide agents, see get_agent
+_agents_lock = threading.Lock()
+
+
+def get_agent(use_asyncio: bool = False) -> Union[DynoscaleAgent, AsyncDynoscaleAgent]:
+    """Returns the agent shared by all integrations in this process, creates it on first use.
+
+    Wrapping several apps or combining the Gunicorn hook with DynoscaleWsgiApp therefore still runs a single logging
+    thread with a single publisher, repository connection and HTTP session.
+
+    :param use_asyncio: return the AsyncDynoscaleAgent, which runs on the event loop of the first request it logs
+    """
+    agent = _agents.get(use_asyncio)
+    if agent is None:
+        with _agents_lock:
+            agent = _agents.get(use_asyncio)
+            if agent is None:
+                agent = AsyncDynoscaleAgent() if use_asyncio else DynoscaleAgent()
+                _agents[use_asyncio] = agent
+    return agent
@@ -0,0 +1,55 @@
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from dynoscale.repository import Record
+
+AGGREGATE_QUANTILES = (0.5, 0.9, 0.99)  # Quantiles reported in the metadata of every bucket
+
+
+def quantile(sorted_values: Sequence[int], q: float) -> int:
+    """Nearest-rank quantile of already sorted values"""
+    return sorted_values[max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))]
+
+
+def bucket_metadata(sorted_values: Sequence[int], quantiles: Sequence[float] = AGGREGATE_QUANTILES) -> str:
+    """Summary of a bucket, ex.: count=3;sum=60;min=10;max=30;p50=20;p90=30;p99=30"""
+    stats = [
+        ('count', len(sorted_values)),
+        ('sum', sum(sorted_values)),
+        ('min', sorted_values[0]),
+        ('max', sorted_values[-1]),
+    ]
+    stats += [(f"p{q * 100:g}", quantile(sorted_values, q)) for q in quantiles]
+    return ';'.join(f"{name}={value}" for name, value in stats)
+
+
+class QueueTimeAggregator:
+    """Folds queue time records into one record per second and source.
+
+    The aggregated record keeps the timestamp and source, its metric is the longest queue time in that second and
+    its metadata summarizes the whole bucket (see ``bucket_metadata``).
+    """
+
+    def __init__(self, quantiles: Sequence[float] = AGGREGATE_QUANTILES):
+        self.quantiles: Sequence[float] = quantiles
+        self._buckets: Dict[Tuple[int, str], List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def add(self, record: Record):
+        key = (record.timestamp, record.source)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [record.metric]
+        else:
+            bucket.append(record.metric)
+
+    def flush(self, before: Optional[int] = None) -> List[Record]:
+        """Removes and returns aggregated records of buckets older than `before` (all of them if None)"""
+        keys = sorted(k for k in self._buckets if before is None or k[0] < before)
+        records = []
+        for timestamp, source in keys:
+            values = sorted(self._buckets.pop((timestamp, source)))
+            records.append(Record(timestamp, values[-1], source, bucket_metadata(values, self.quantiles)))
+        return records
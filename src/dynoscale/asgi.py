@@ -1,11 +1,12 @@
+import asyncio
 import logging
 
 from asgiref.typing import ASGI3Application, ASGIReceiveCallable, ASGISendCallable, Scope
 
-from dynoscale.agent import DynoscaleAgent
+from dynoscale.agent import AsyncDynoscaleAgent, DynoscaleAgent, get_agent
 from dynoscale.config import Config
-from dynoscale.constants import X_REQUEST_START
-from dynoscale.utils import epoch_ms, fake_request_start_ms, get_int_from_bytestring_headers
+from dynoscale.constants import X_REQUEST_START_BYTES, TRACE_LOGGER_NAME
+from dynoscale.utils import epoch_ms, fake_request_start_ms, get_int_from_asgi_headers, Sampler
 
 
 class DynoscaleAsgiApp(ASGI3Application):
@@ -16,13 +17,15 @@ class DynoscaleAsgiApp(ASGI3Application):
         self.__app = app
 
         self.config = Config()
+        self.trace_logger: logging.Logger = logging.getLogger(TRACE_LOGGER_NAME)
+        self.should_trace = Sampler(self.config.trace_sample_rate)
         if self.config.is_not_valid:
             self.logger.warning(
                 f"{DynoscaleAsgiApp.__name__} will not "
                 f"initialize {DynoscaleAgent.__name__} with invalid config: {self.config}."
             )
             return  # User app will keep running, but queue times won't be logged
-        self.ds_agent = DynoscaleAgent()
+        self.ds_agent = get_agent(use_asyncio=self.config.is_asyncio)
         self.logger.info(f"{DynoscaleAsgiApp.__name__} started in {self.config.run_mode_name} mode.")
 
     async def __call__(self, scope: Scope, receive: ASGIReceiveCallable, send: ASGISendCallable) -> None:
@@ -34,28 +37,66 @@ class DynoscaleAsgiApp(ASGI3Application):
                 self.log_queue_time(scope.get('headers'))
             else:
                 self.logger.debug("Scope type is not `http`.")
+                if scope.get('type') == 'lifespan' and self.config.is_valid:
+                    receive = self.follow_lifespan(receive)
         except Exception as e:
-            self.logger.error(f"Unknown error, while processing ASGI __call__ {e}")
+            self.logger.error("Unknown error, while processing ASGI __call__ %s", e)
         finally:
             scope["app"] = self
             await self.__app(scope, receive, send)
 
+    def follow_lifespan(self, receive: ASGIReceiveCallable) -> ASGIReceiveCallable:
+        """Wraps receive of the lifespan scope, so that the agent starts with the server, before the first request, and
+        remaining queue times are published when the server stops"""
+
+        async def receive_and_follow():
+            message = await receive()
+            if message.get('type') == 'lifespan.startup':
+                self.startup()
+            elif message.get('type') == 'lifespan.shutdown':
+                await self.shutdown()
+            return message
+
+        return receive_and_follow
+
+    def startup(self):
+        try:
+            if isinstance(self.ds_agent, AsyncDynoscaleAgent):
+                self.ds_agent.start()
+        except Exception as e:
+            self.logger.error("Unknown error while starting Dynoscale agent: %s", e)
+
+    async def shutdown(self):
+        try:
+            if isinstance(self.ds_agent, AsyncDynoscaleAgent):
+                await self.ds_agent.shutdown()
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, self.ds_agent.shutdown)
+        except Exception as e:
+            self.logger.error("Unknown error while shutting down Dynoscale agent: %s", e)
+
     def log_queue_time(self, headers):
         # Under no circumstances should we ever stop user app from receiving the request
         try:
-            self.logger.debug(f"log_queue_time (e:{headers})")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("log_queue_time (e:%s)", headers)
             log_start = epoch_ms()
-            http_x_request_start = get_int_from_bytestring_headers(
+            http_x_request_start = get_int_from_asgi_headers(
                 headers,
-                X_REQUEST_START,
+                X_REQUEST_START_BYTES,
                 fake_request_start_ms() if self.config.is_dev_mode else None
             )
             if http_x_request_start is not None:
                 req_queue_time: int = log_start - http_x_request_start
                 req_timestamp = int(log_start / 1_000)
-                self.logger.debug(f"log_queue_time - Logging queue time {req_queue_time}")
+                self.logger.debug("log_queue_time - Logging queue time %s", req_queue_time)
                 self.ds_agent.log_queue_time(req_timestamp, req_queue_time)
             else:
-                self.logger.warning(f"Can not calculate queue time from request headers: {headers}")
+                self.logger.info("Can not calculate queue time.")
+            if self.should_trace():
+                self.trace_logger.info(
+                    "%s request start: %s, logged at: %s, headers: %s",
+                    DynoscaleAsgiApp.__name__, http_x_request_start, log_start, headers
+                )
         except Exception as e:
-            self.logger.error(f"Unknown error while attempting to log a queue time: {e}")
+            self.logger.error("Unknown error while attempting to log a queue time: %s", e)
@@ -0,0 +1,82 @@
+import threading
+from collections import deque
+from enum import Enum
+from typing import Any, List, Optional
+
+DEFAULT_BUFFER_CAPACITY = 10_000  # Maximum number of records held in memory before they're dropped
+
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+
+class RingBuffer:
+    """Fixed capacity buffer handing records from request threads to the Dynoscale agent thread.
+
+    Putting a record never blocks, when the buffer is full either the oldest buffered record or the new one is
+    dropped (depending on the policy) and counted in ``dropped``. Only the consumer ever waits.
+
+    :param capacity: maximum number of buffered records
+    :param policy: which record to drop when the buffer is full
+    """
+
+    def __init__(self, capacity: int = DEFAULT_BUFFER_CAPACITY, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST):
+        if capacity < 1:
+            raise ValueError(f"RingBuffer capacity has to be positive, got {capacity}.")
+        self.capacity: int = capacity
+        self.policy: OverflowPolicy = policy
+        self.dropped: int = 0  # best effort, concurrent producers may race on the increment
+        self.closed: bool = False
+        self._items: deque = deque(maxlen=capacity)
+        self._not_empty: threading.Event = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any) -> bool:
+        """Adds item without ever blocking, returns False if the item itself was dropped."""
+        items = self._items
+        if len(items) >= self.capacity:
+            self.dropped += 1
+            if self.policy is OverflowPolicy.DROP_NEWEST:
+                return False
+        items.append(item)  # a full deque with maxlen discards the oldest item atomically
+        if not self._not_empty.is_set():
+            self._not_empty.set()
+        return True
+
+    def close(self):
+        """Wakes up the consumer, from now on it never waits for items and gets None once the buffer is empty"""
+        self.closed = True
+        self._not_empty.set()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """Removes and returns the oldest item, waits up to timeout seconds (forever if None) and returns None if
+        nothing arrived in time or the buffer is closed and empty."""
+        while True:
+            try:
+                return self._items.popleft()
+            except IndexError:
+                if self.closed:
+                    return None
+                self._not_empty.clear()
+                if self._items or self.closed:  # something happened between popleft and clear, don't wait
+                    continue
+                if not self._not_empty.wait(timeout):
+                    return None
+
+    def drain(self, max_items: int, timeout: Optional[float] = None) -> List[Any]:
+        """Removes and returns up to max_items oldest items, waits up to timeout seconds (forever if None) for the
+        first one and returns an empty list if nothing arrived in time."""
+        first = self.get(timeout)
+        if first is None:
+            return []
+        batch = [first]
+        popleft = self._items.popleft
+        try:
+            while len(batch) < max_items:
+                batch.append(popleft())
+        except IndexError:
+            pass
+        return batch
@@ -0,0 +1,192 @@
+import logging
+import os
+import select
+import struct
+import threading
+from multiprocessing import shared_memory
+from typing import List, Optional
+
+from dynoscale.agent import DynoscaleAgent
+
+SAMPLE = struct.Struct('!qq')  # timestamp in seconds, queue time in milliseconds
+RECEIVE_BATCH_SIZE = 256  # Maximum number of samples read from the pipe at once
+RECEIVE_TIMEOUT = 1.0  # How often the collector thread checks whether it was closed
+LANE_HEADER = struct.Struct('qq')  # number of samples ever written and read, native so it stays aligned
+SHM_LANES = 64  # Maximum number of workers with a lane in the shared memory ring at the same time
+SHM_LANE_CAPACITY = 1_024  # Samples a lane holds before new ones are dropped
+SHM_DRAIN_INTERVAL = 0.1  # How often the collector thread reads the samples from all lanes
+
+
+class PipeSampleSender:
+    """Sends queue times from a worker process to the PipeCollector it was forked from.
+
+    Has the same ``log_queue_time`` as DynoscaleAgent, but never starts a thread or opens the repository. Every
+    sample is a single write smaller than PIPE_BUF, so writes from many workers never interleave. Writing never
+    blocks, samples that don't fit into a full pipe are counted in ``dropped``.
+    """
+
+    def __init__(self, fd: int):
+        self.fd: int = fd
+        self.dropped: int = 0
+
+    def log_queue_time(self, timestamp: int, queue_time: int):
+        try:
+            os.write(self.fd, SAMPLE.pack(timestamp, queue_time))
+        except (OSError, struct.error):
+            self.dropped += 1
+
+
+class PipeCollector:
+    """Receives queue times from the workers through a pipe and logs them with a single DynoscaleAgent.
+
+    Meant to be created in the Gunicorn master before the workers are forked, so there is one agent thread, one
+    publisher and one repository connection per dyno no matter how many workers there are.
+    """
+
+    def __init__(self, agent: DynoscaleAgent):
+        self.logger: logging.Logger = logging.getLogger(f"{__name__}.{PipeCollector.__name__}")
+        self.agent: DynoscaleAgent = agent
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.write_fd, False)
+        self._closed: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(target=self._receive, daemon=True, name='DynoscaleCollector')
+
+    def sender(self) -> PipeSampleSender:
+        return PipeSampleSender(self.write_fd)
+
+    def start(self):
+        self._thread.start()
+        self.logger.info(f"Dynoscale collector started, reading samples from fd {self.read_fd}.")
+
+    def _receive(self):
+        pending = b''
+        while not self._closed.is_set():
+            try:
+                readable, _, _ = select.select([self.read_fd], [], [], RECEIVE_TIMEOUT)
+                if not readable:
+                    continue
+                pending += os.read(self.read_fd, SAMPLE.size * RECEIVE_BATCH_SIZE)
+            except (OSError, ValueError):
+                return  # pipe was closed
+            complete = len(pending) - len(pending) % SAMPLE.size
+            for timestamp, queue_time in SAMPLE.iter_unpack(pending[:complete]):
+                self.agent.log_queue_time(timestamp, queue_time)
+            pending = pending[complete:]
+
+    def close(self):
+        self._closed.set()
+        if self._thread.is_alive():
+            self._thread.join(RECEIVE_TIMEOUT * 2)
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.logger.info("Dynoscale collector closed.")
+
+
+class SharedMemorySampleSender:
+    """Appends queue times of a single worker to its own lane of the SharedMemoryCollector ring.
+
+    Logging a queue time is two writes into shared memory, no syscall and no lock. The worker is the only writer of
+    its lane, so it only has to publish the sample by bumping the lane's write count after the sample is written.
+    When the collector falls behind and the lane is full, the sample is dropped and counted in ``dropped``.
+    """
+
+    def __init__(self, buf: memoryview, lane: int, capacity: int):
+        self.buf: memoryview = buf
+        self.capacity: int = capacity
+        self.dropped: int = 0
+        self._header: int = lane * (LANE_HEADER.size + capacity * SAMPLE.size)
+        self._slots: int = self._header + LANE_HEADER.size
+        self._written, _ = LANE_HEADER.unpack_from(buf, self._header)  # a reused lane continues where it ended
+
+    def log_queue_time(self, timestamp: int, queue_time: int):
+        written = self._written
+        try:
+            _, read = LANE_HEADER.unpack_from(self.buf, self._header)
+        except ValueError:  # the shared memory was already closed
+            self.dropped += 1
+            return
+        if written - read >= self.capacity:
+            self.dropped += 1
+            return
+        try:
+            SAMPLE.pack_into(self.buf, self._slots + (written % self.capacity) * SAMPLE.size, timestamp, queue_time)
+        except (struct.error, ValueError):  # ValueError when the shared memory was already closed
+            self.dropped += 1
+            return
+        self._written = written + 1
+        struct.pack_into('q', self.buf, self._header, self._written)
+
+
+class SharedMemoryCollector:
+    """Drains queue times the workers append to a shared memory ring and logs them with a single DynoscaleAgent.
+
+    The ring is split into lanes with a single writer each, the Gunicorn master hands a free lane to every worker
+    before forking it (``acquire_lane``) and takes it back when the worker exits (``release_lane``).
+    """
+
+    def __init__(self, agent: DynoscaleAgent, lanes: int = SHM_LANES, lane_capacity: int = SHM_LANE_CAPACITY):
+        self.logger: logging.Logger = logging.getLogger(f"{__name__}.{SharedMemoryCollector.__name__}")
+        self.agent: DynoscaleAgent = agent
+        self.lanes: int = lanes
+        self.lane_capacity: int = lane_capacity
+        self._lane_size: int = LANE_HEADER.size + lane_capacity * SAMPLE.size
+        self.shm: shared_memory.SharedMemory = shared_memory.SharedMemory(create=True, size=lanes * self._lane_size)
+        self.shm.buf[:lanes * self._lane_size] = bytes(lanes * self._lane_size)
+        self._free_lanes: List[int] = list(range(lanes))
+        self._closed: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(target=self._receive, daemon=True, name='DynoscaleCollector')
+
+    def acquire_lane(self) -> Optional[int]:
+        """Reserves a lane for a worker about to be forked, returns None when all lanes are taken"""
+        if not self._free_lanes:
+            self.logger.warning(f"All {self.lanes} lanes of the Dynoscale collector are taken.")
+            return None
+        return self._free_lanes.pop(0)
+
+    def release_lane(self, lane: int):
+        if lane not in self._free_lanes:
+            self._free_lanes.append(lane)
+            self._free_lanes.sort()
+
+    def sender(self, lane: int) -> SharedMemorySampleSender:
+        return SharedMemorySampleSender(self.shm.buf, lane, self.lane_capacity)
+
+    def start(self):
+        self._thread.start()
+        self.logger.info(f"Dynoscale collector started, reading samples from shared memory {self.shm.name}.")
+
+    def drain(self) -> int:
+        """Logs the samples waiting in all lanes with the agent, returns how many there were"""
+        buf = self.shm.buf
+        drained = 0
+        for lane in range(self.lanes):
+            header = lane * self._lane_size
+            written, read = LANE_HEADER.unpack_from(buf, header)
+            if written == read:
+                continue
+            slots = header + LANE_HEADER.size
+            for position in range(read, written):
+                timestamp, queue_time = SAMPLE.unpack_from(buf, slots + (position % self.lane_capacity) * SAMPLE.size)
+                self.agent.log_queue_time(timestamp, queue_time)
+            struct.pack_into('q', buf, header + LANE_HEADER.size // 2, written)
+            drained += written - read
+        return drained
+
+    def _receive(self):
+        while not self._closed.wait(SHM_DRAIN_INTERVAL):
+            self.drain()
+
+    def close(self):
+        self._closed.set()
+        if self._thread.is_alive():
+            self._thread.join(SHM_DRAIN_INTERVAL * 10)
+        self.drain()
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.logger.info("Dynoscale collector closed.")
@@ -1,10 +1,11 @@
 import json
 import os
 from enum import Enum
-from typing import Dict
+from typing import Dict, Optional
 
+from dynoscale.buffer import DEFAULT_BUFFER_CAPACITY, OverflowPolicy
 from dynoscale.constants import *
-from dynoscale.repository import DEFAULT_DYNOSCALE_REPOSITORY_FILENAME
+from dynoscale.repository import DEFAULT_DYNOSCALE_REPOSITORY_FILENAME, RepositoryBackend
 from dynoscale.utils import is_valid_url, ensure_module
 
 
@@ -20,11 +21,43 @@ def get_redis_urls_from_environ() -> Dict[str, str]:
     return {name: os.environ[name] for name in redis_env_vars if name in os.environ}
 
 
+def get_positive_int_from_environ(name: str, default: int) -> int:
+    """Returns a positive int from environment variable `name` or default if it is missing or invalid"""
+    try:
+        value = int(os.environ.get(name, default))
+        return value if value > 0 else default
+    except ValueError:
+        return default
+
+
+def get_overflow_policy_from_environ() -> OverflowPolicy:
+    """Returns the buffer overflow policy from environment, drop_oldest unless drop_newest is requested"""
+    value = os.environ.get(ENV_DYNOSCALE_BUFFER_POLICY, '').strip().lower()
+    return OverflowPolicy.DROP_NEWEST if value == OverflowPolicy.DROP_NEWEST.value else OverflowPolicy.DROP_OLDEST
+
+
+def get_repository_backend_from_environ() -> RepositoryBackend:
+    """Returns the repository backend from environment, sqlite unless another known backend is requested"""
+    value = os.environ.get(ENV_DYNOSCALE_REPOSITORY, '').strip().lower()
+    return next((backend for backend in RepositoryBackend if backend.value == value), RepositoryBackend.SQLITE)
+
+
 class RunMode(Enum):
     PRODUCTION = 1
     DEVELOPMENT = 2
 
 
+class CollectorMode(Enum):
+    PIPE = 'pipe'
+    SHM = 'shm'
+
+
+def get_collector_mode_from_environ() -> Optional[CollectorMode]:
+    """Returns the requested collector mode, or None if queue times should be logged by each worker on its own"""
+    value = os.environ.get(ENV_DYNOSCALE_COLLECTOR, '').strip().lower()
+    return next((mode for mode in CollectorMode if mode.value == value), None)
+
+
 class Config:
 
     @property
@@ -58,6 +91,13 @@ class Config:
         self.redis_urls = get_redis_urls_from_environ()
         self.repository_dir_name = os.environ.get(ENV_DYNOSCALE_DATA_DIR_NAME, os.getcwd())
         self.repository_file_name = os.environ.get(ENV_DYNOSCALE_DATA_FILE_NAME, DEFAULT_DYNOSCALE_REPOSITORY_FILENAME)
+        self.buffer_capacity = get_positive_int_from_environ(ENV_DYNOSCALE_BUFFER_CAPACITY, DEFAULT_BUFFER_CAPACITY)
+        self.buffer_overflow_policy = get_overflow_policy_from_environ()
+        self.is_aggregating = bool(os.environ.get(ENV_DYNOSCALE_AGGREGATE, False))
+        self.trace_sample_rate = get_positive_int_from_environ(ENV_DYNOSCALE_TRACE_SAMPLE_RATE, 0)
+        self.collector_mode = get_collector_mode_from_environ()
+        self.is_asyncio = bool(os.environ.get(ENV_DYNOSCALE_ASYNCIO, False))
+        self.repository_backend = get_repository_backend_from_environ()
 
     def __repr__(self) -> str:
         obj = {
@@ -4,6 +4,16 @@ ENV_HEROKU_DYNO = 'DYNO'
 ENV_DYNOSCALE_URL = 'DYNOSCALE_URL'
 ENV_DYNOSCALE_DATA_DIR_NAME = "DYNOSCALE_DATA_DIR_NAME"
 ENV_DYNOSCALE_DATA_FILE_NAME = "DYNOSCALE_DATA_FILE_NAME"
+ENV_DYNOSCALE_BUFFER_CAPACITY = "DYNOSCALE_BUFFER_CAPACITY"
+ENV_DYNOSCALE_BUFFER_POLICY = "DYNOSCALE_BUFFER_POLICY"
+ENV_DYNOSCALE_AGGREGATE = "DYNOSCALE_AGGREGATE"
+ENV_DYNOSCALE_TRACE_SAMPLE_RATE = "DYNOSCALE_TRACE_SAMPLE_RATE"
+ENV_DYNOSCALE_COLLECTOR = "DYNOSCALE_COLLECTOR"
+ENV_DYNOSCALE_ASYNCIO = "DYNOSCALE_ASYNCIO"
+ENV_DYNOSCALE_REPOSITORY = "DYNOSCALE_REPOSITORY"
+
+# Logging
+TRACE_LOGGER_NAME = "dynoscale.trace"
 
 # Redis
 ENV_REDIS_TLS_URL = 'REDIS_TLS_URL'
@@ -20,3 +30,4 @@ ENV_REDISCLOUD_URL = 'REDISCLOUD_URL'
 # Header
 HTTP_X_REQUEST_START = 'HTTP_X_REQUEST_START'
 X_REQUEST_START = 'X-REQUEST-START'
+X_REQUEST_START_BYTES = b'x-request-start'
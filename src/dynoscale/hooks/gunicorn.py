@@ -1,32 +1,130 @@
 import logging
+import os
 
-from dynoscale.agent import DynoscaleAgent
-from dynoscale.config import Config
-from dynoscale.constants import X_REQUEST_START
-from dynoscale.utils import epoch_ms, get_int_from_headers, fake_request_start_ms
+from dynoscale.agent import get_agent
+from dynoscale.collector import PipeCollector, SharedMemoryCollector
+from dynoscale.config import Config, CollectorMode
+from dynoscale.constants import X_REQUEST_START, TRACE_LOGGER_NAME
+from dynoscale.utils import epoch_ms, get_int_from_headers, fake_request_start_ms, Sampler
 
 PROC_NAME = '__dynoscale_hook_processor'
+COLLECTOR_NAME = '__dynoscale_collector'
+LANE_ATTRIBUTE = 'dynoscale_lane'
+SENDER_NAME = '__dynoscale_sender'
 
 logger = logging.getLogger(__name__)
 
 
 def pre_request(worker, req):
-    logger.debug(f"pre_request - {worker} {req}")
+    logger.debug("pre_request - %s %s", worker, req)
     processor = globals().get(PROC_NAME, None)
     if processor is None:
-        processor = GunicornHookProcessor()
+        processor = GunicornHookProcessor(worker)
         globals()[PROC_NAME] = processor
     processor.pre_request(worker, req)
 
 
+def when_ready(server):
+    """Starts a single collector and agent in the Gunicorn master when DYNOSCALE_COLLECTOR is `pipe` or `shm`.
+
+    Workers forked afterwards inherit the collector and only send it their queue times.
+    """
+    config = Config()
+    if config.collector_mode is None:
+        return
+    if config.is_not_valid:
+        logger.warning(f"Dynoscale can't start collector with invalid config: {config}.")
+        return
+    try:
+        if config.collector_mode is CollectorMode.SHM:
+            collector = SharedMemoryCollector(get_agent())
+        else:
+            collector = PipeCollector(get_agent())
+        collector.start()
+        globals()[COLLECTOR_NAME] = collector
+    except Exception as e:
+        logger.error(f"Dynoscale couldn't start collector, workers will log queue times on their own: {e}")
+
+
+def pre_fork(server, worker):
+    """Reserves a lane of the shared memory collector for the worker about to be forked.
+
+    The lane is also kept on the collector, Gunicorn forks right after this hook, so the worker inherits its own
+    lane and DynoscaleWsgiApp, which never sees the worker, can find it.
+    """
+    collector = globals().get(COLLECTOR_NAME, None)
+    if isinstance(collector, SharedMemoryCollector):
+        lane = collector.acquire_lane()
+        setattr(worker, LANE_ATTRIBUTE, lane)
+        collector.forked_lane = lane
+
+
+def child_exit(server, worker):
+    collector = globals().get(COLLECTOR_NAME, None)
+    lane = getattr(worker, LANE_ATTRIBUTE, None)
+    if isinstance(collector, SharedMemoryCollector) and lane is not None:
+        collector.release_lane(lane)
+
+
+def worker_exit(server, worker):
+    """Publishes the worker's remaining queue times, ex.: when it's recycled after max_requests"""
+    processor = globals().get(PROC_NAME, None)
+    if processor is not None:
+        shutdown_agent(getattr(processor, 'ds_agent', None))
+
+
+def on_exit(server):
+    globals().pop(SENDER_NAME, None)
+    collector = globals().pop(COLLECTOR_NAME, None)
+    if collector is not None:
+        collector.close()
+        shutdown_agent(collector.agent)
+
+
+def shutdown_agent(agent):
+    """Shuts down an agent, senders to a collector have nothing to shut down"""
+    shutdown = getattr(agent, 'shutdown', None)
+    if callable(shutdown):
+        try:
+            shutdown()
+        except Exception as e:
+            logger.error(f"Dynoscale couldn't shut down agent: {e}")
+
+
+def collector_sender(worker=None):
+    """Returns a sender of queue times to the collector inherited from the master, None if there is no usable one.
+
+    A worker process gets a single sender, shared by the hook and DynoscaleWsgiApp, a shared memory lane must only
+    ever have one writer.
+    """
+    collector = globals().get(COLLECTOR_NAME, None)
+    if collector is None:
+        return None
+    cached = globals().get(SENDER_NAME, None)
+    if cached is not None and cached[0] == os.getpid() and cached[1] is collector:
+        return cached[2]
+    if isinstance(collector, SharedMemoryCollector):
+        lane = getattr(worker, LANE_ATTRIBUTE, getattr(collector, 'forked_lane', None))
+        if lane is None:
+            return None
+        sender = collector.sender(lane)
+    else:
+        sender = collector.sender()
+    globals()[SENDER_NAME] = (os.getpid(), collector, sender)
+    return sender
+
+
 class GunicornHookProcessor:
 
-    def __init__(self):
+    def __init__(self, worker=None):
         self.logger: logging.Logger = logging.getLogger(f"{__name__}.{GunicornHookProcessor.__name__}")
         self.config = Config()
+        self.trace_logger: logging.Logger = logging.getLogger(TRACE_LOGGER_NAME)
+        self.should_trace = Sampler(self.config.trace_sample_rate)
         if self.config.is_valid:
             self.logger.info(f"Dynoscale started {GunicornHookProcessor.__name__} in {self.config.run_mode_name} mode.")
-            self.ds_agent = DynoscaleAgent()
+            # a collector inherited from the master logs the queue times for all workers
+            self.ds_agent = collector_sender(worker) or get_agent()
         else:
             self.logger.warning(
                 f"Dynoscale can't start {GunicornHookProcessor.__name__} with invalid config: {self.config}."
@@ -36,7 +134,8 @@ class GunicornHookProcessor:
     def pre_request(self, worker, req):
         # Under no circumstances should we ever stop user app from receiving the request
         try:
-            self.logger.debug(f"pre_request (w:{id(worker)} w.pid{worker.pid} rq:{id(req)})")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("pre_request (w:%s w.pid%s rq:%s)", id(worker), worker.pid, id(req))
             log_start: int = epoch_ms()
             http_x_request_start = get_int_from_headers(
                 req.headers,
@@ -46,9 +145,14 @@ class GunicornHookProcessor:
             if http_x_request_start is not None:
                 req_queue_time: int = log_start - http_x_request_start
                 req_timestamp = int(log_start / 1_000)
-                self.logger.debug(f"pre_request - Logging queue time: {req_queue_time}")
+                self.logger.debug("pre_request - Logging queue time: %s", req_queue_time)
                 self.ds_agent.log_queue_time(req_timestamp, req_queue_time)
             else:
                 self.logger.info("Can not calculate queue time.")
+            if self.should_trace():
+                self.trace_logger.info(
+                    "%s worker pid: %s, request start: %s, logged at: %s, headers: %s",
+                    GunicornHookProcessor.__name__, worker.pid, http_x_request_start, log_start, req.headers
+                )
         except Exception as e:
-            self.logger.error(f"Unknown error while attempting to log a queue time: {e}")
+            self.logger.error("Unknown error while attempting to log a queue time: %s", e)
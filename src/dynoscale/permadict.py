@@ -1,8 +1,77 @@
 import pickle
 import sqlite3
+import struct
+from collections import OrderedDict
 from contextlib import contextmanager
 
-from collections.abc import MutableMapping
+from collections.abc import Mapping, MutableMapping
+
+_MISSING = object()
+_FLOAT = struct.Struct('<d')
+
+
+class PickleCodec:
+    """Stores any picklable value with ``pickle.HIGHEST_PROTOCOL``"""
+
+    def encode(self, value) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data: bytes):
+        return pickle.loads(data)
+
+
+class PrimitiveCodec(PickleCodec):
+    """Stores None, int, float, str and bytes behind a one byte tag without pickle, anything else is pickled.
+
+    Pickles of protocol 2 and newer start with 0x80, which is never a tag, so values pickled by PickleCodec are
+    still read back. Unpickling can run arbitrary code, with ``allow_pickle=False`` only the tagged primitives are
+    accepted and anything else raises, use that for databases that may be tampered with.
+
+    :param allow_pickle: fall back to pickle for other values (the default), raise TypeError or ValueError if False
+    """
+    NONE = b'N'
+    INT = b'i'
+    FLOAT = b'f'
+    STR = b's'
+    BYTES = b'b'
+
+    def __init__(self, allow_pickle: bool = True):
+        self.allow_pickle = allow_pickle
+
+    def encode(self, value) -> bytes:
+        kind = type(value)  # exact types, a bool or an int subclass must come back as what it was
+        if kind is str:
+            return self.STR + value.encode()
+        if kind is float:
+            return self.FLOAT + _FLOAT.pack(value)
+        if kind is int:
+            return self.INT + str(value).encode()
+        if kind is bytes:
+            return self.BYTES + value
+        if value is None:
+            return self.NONE
+        if not self.allow_pickle:
+            raise TypeError(f"PrimitiveCodec without pickle can't store {kind.__name__}.")
+        return super().encode(value)
+
+    def decode(self, data: bytes):
+        tag = data[:1]
+        if tag == self.STR:
+            return data[1:].decode()
+        if tag == self.FLOAT:
+            try:
+                return _FLOAT.unpack_from(data, 1)[0]
+            except struct.error as e:  # truncated, callers only need to handle ValueError
+                raise ValueError(f"PrimitiveCodec can't read a float from {len(data)} bytes.") from e
+        if tag == self.INT:
+            return int(data[1:])
+        if tag == self.BYTES:
+            return bytes(data[1:])
+        if tag == self.NONE:
+            return None
+        if not self.allow_pickle:
+            raise ValueError(f"PrimitiveCodec without pickle can't read a value tagged {tag!r}.")
+        return super().decode(data)
 
 
 # noinspection SqlNoDataSourceInspection,SqlResolve
@@ -12,18 +81,24 @@ class Permadict(MutableMapping):
     :param filename: path to database or ``:memory:`` (the default)
     :param journal_mode: SQLite journal mode to use (default: "OFF")
     :param synchronous: when False (the default), set ``PRAGMA synchronous = OFF``
+    :param cache_size: number of recently used values kept in memory, 0 (the default) disables the cache. Writes go
+        through the cache to the database, but values written by other connections aren't seen once cached.
+    :param codec: turns values into bytes and back, :class:`PrimitiveCodec` (the default) or :class:`PickleCodec`
     :param kwargs: keyword arguments to initialize keys and values with
 
     """
 
-    def __init__(self, filename=":memory:", journal_mode="OFF", synchronous=False, **kwargs):
+    def __init__(self, filename=":memory:", journal_mode="OFF", synchronous=False, cache_size=0, codec=None,
+                 **kwargs):
         self.filename = filename
         self.conn = sqlite3.connect(self.filename)
+        self.cache_size = cache_size
+        self.codec = codec if codec is not None else PrimitiveCodec()
+        self._cache = OrderedDict()
         self._create_table(journal_mode, synchronous)
 
         if len(kwargs) > 0:
-            for key, value in kwargs.items():
-                self[key] = value
+            self.update(kwargs)
 
     def __enter__(self):
         return self
@@ -52,37 +127,49 @@ class Permadict(MutableMapping):
             for statement in sql:
                 cursor.execute(statement)
 
+    def _cache_put(self, key, value):
+        if self.cache_size > 0:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
     def __len__(self):
         with self.cursor() as cur:
             cur.execute("SELECT COUNT(*) FROM dict")
             return cur.fetchone()[0]
 
     def __getitem__(self, key):
+        value = self._cache.get(key, _MISSING)
+        if value is not _MISSING:
+            self._cache.move_to_end(key)
+            return value
         with self.cursor() as cur:
             cur.execute("SELECT object FROM dict WHERE name = (?)", (key,))
             obj = cur.fetchone()
             if obj is None:
-                raise KeyError("No such key: " + key)
-            key = obj[0]
-            return pickle.loads(key)
+                raise KeyError(key)
+            value = self.codec.decode(obj[0])
+        self._cache_put(key, value)
+        return value
 
     def __setitem__(self, key, value):
         with self.cursor() as cur:
-            binary = sqlite3.Binary(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            binary = sqlite3.Binary(self.codec.encode(value))
             cur.execute("INSERT OR REPLACE INTO dict VALUES (?,?)", (key, binary))
+        self._cache_put(key, value)
 
     def __delitem__(self, key):
-        if key in self:
-            with self.cursor() as cur:
-                cur.execute("DELETE FROM dict WHERE name = (?)", (key,))
+        self._cache.pop(key, None)
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM dict WHERE name = (?)", (key,))
 
     def __contains__(self, key):
-        try:
-            # noinspection PyStatementEffect
-            self[key]
+        if key in self._cache:
             return True
-        except KeyError:
-            return False
+        with self.cursor() as cur:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM dict WHERE name = (?))", (key,))
+            return bool(cur.fetchone()[0])
 
     def __iter__(self):
         for key in self.keys():
@@ -94,16 +181,24 @@ class Permadict(MutableMapping):
             return [key[0] for key in cur.fetchall()]
 
     def items(self):
-        for key in self:
-            yield key, self[key]
+        """A generator which iterates over the :class:`Permadict`'s key/value pairs, read with a single query."""
+        with self.cursor() as cur:
+            cur.execute("SELECT name, object FROM dict")
+            rows = cur.fetchall()
+        for key, obj in rows:
+            yield key, self.codec.decode(obj)
 
     def values(self):
-        """A generator which iterates over the :class:`Permadict`'s values."""
-        for key in self:
-            yield self[key]
+        """A generator which iterates over the :class:`Permadict`'s values, read with a single query."""
+        with self.cursor() as cur:
+            cur.execute("SELECT object FROM dict")
+            rows = cur.fetchall()
+        for obj, in rows:
+            yield self.codec.decode(obj)
 
     def clear(self):
         """Remove all items from the Permadict."""
+        self._cache.clear()
         with self.cursor() as cur:
             # noinspection SqlWithoutWhere
             cur.execute("DELETE FROM dict")
@@ -118,32 +213,46 @@ class Permadict(MutableMapping):
         except KeyError:
             return default
 
-    def pop(self, key):
-        """If ``key`` is present, remove it and return its value, else raise a
-        :class:`KeyError`.
+    def pop(self, key, default=_MISSING):
+        """If ``key`` is present, remove it and return its value, else return
+        ``default`` or raise a :class:`KeyError` if it wasn't given.
 
         """
-        try:
-            value = self[key]
-            del self[key]
-            return value
-        except KeyError:
-            raise
+        self._cache.pop(key, None)
+        with self.cursor() as cur:
+            # the select doesn't start a transaction on its own, another connection could pop the same value
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT object FROM dict WHERE name = (?)", (key,))
+            obj = cur.fetchone()
+            if obj is not None:
+                cur.execute("DELETE FROM dict WHERE name = (?)", (key,))
+        if obj is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return self.codec.decode(obj[0])
 
-    def update(self, iterable, **kwargs):
+    def update(self, iterable=(), **kwargs):
         """Update the :class:`Permadict` with the key/value pairs of
-        ``iterable``.
+        ``iterable`` and ``kwargs``, all of them in a single transaction.
 
         Returns ``None``.
 
         """
-        if isinstance(iterable, dict):
+        if isinstance(iterable, Mapping):
             iter_ = iterable.items()
         else:
             iter_ = iterable
-        for key, value in iter_:
-            self[key] = value
+        pairs = list(iter_) + list(kwargs.items())
+        with self.cursor() as cur:
+            cur.executemany(
+                "INSERT OR REPLACE INTO dict VALUES (?,?)",
+                ((key, sqlite3.Binary(self.codec.encode(value))) for key, value in pairs)
+            )
+        for key, value in pairs:
+            self._cache_put(key, value)
         return None
 
     def close(self):
+        self._cache.clear()
         self.conn.close()
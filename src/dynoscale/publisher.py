@@ -1,23 +1,40 @@
 import csv
+import gzip
 import logging
+import random
 import time
 from dataclasses import dataclass
 from io import StringIO
+from itertools import chain
 from json import JSONDecodeError
-from typing import Optional, Iterable, Callable
+from typing import Optional, Iterable, Callable, Dict, Tuple
 
 import requests
 from requests import Session, PreparedRequest, Response, Request
 
 from dynoscale import __version__
 from dynoscale.config import Config
-from dynoscale.repository import DynoscaleRepository, RecordOut
+from dynoscale.repository import Repository, RecordBatch, RecordOut, create_repository
 
 MAX_RECORD_AGE = 300.0  # Records older than this will be discarded before each upload
+PUBLISH_BATCH_SIZE = 5_000  # Maximum number of records read, uploaded and deleted at once
 DEFAULT_PUBLISH_FREQUENCY = 30.0  # Minimum time between publishing records
 KEY_LAST_PUBLISH_ATTEMPT = 'publish_last_attempt'
 KEY_LAST_PUBLISH_SUCCESS = 'publish_last_success'
 KEY_PUBLISH_FREQUENCY = 'publish_frequency'
+KEY_CONTENT_ENCODING = 'content_encoding'
+KEY_PAYLOAD_FORMAT = 'payload_format'
+PAYLOAD_FORMAT_CSV = 'csv'
+PAYLOAD_FORMAT_COMPACT = 'compact'
+CONTENT_TYPES = {PAYLOAD_FORMAT_CSV: 'text/csv', PAYLOAD_FORMAT_COMPACT: 'text/csv; format=compact'}
+CONTENT_ENCODING_GZIP = 'gzip'
+GZIP_COMPRESS_LEVEL = 6  # Nearly the size of level 9 for a fraction of the CPU
+UPLOAD_TIMEOUT = (3.05, 10.0)  # Seconds to connect and to wait between bytes of the response
+UPLOAD_RETRIES = 2  # Additional attempts after a failed upload, only for connection errors, 429 and 5xx
+RETRY_BACKOFF_BASE = 0.5  # Seconds, doubled with every retry and fully jittered
+RETRY_BACKOFF_MAX = 4.0  # Maximum seconds to wait before a retry
+CIRCUIT_FAILURE_THRESHOLD = 3  # Consecutive failed publishes that open the circuit
+CIRCUIT_RESET_TIMEOUT = 60.0  # Seconds the circuit stays open before a single probe is let through
 
 logger = logging.getLogger(__name__)
 
@@ -25,23 +42,68 @@ logger = logging.getLogger(__name__)
 @dataclass
 class ConfigResponse:
     publish_frequency: float
+    content_encoding: Optional[str] = None  # only CONTENT_ENCODING_GZIP is supported
+    payload_format: str = PAYLOAD_FORMAT_CSV
 
 
 def csv_from_records(records: Iterable[RecordOut]) -> bytes:
     """Generates a csv formatted string from Records"""
+    if isinstance(records, RecordBatch):
+        rows = records.rows()
+    else:
+        rows = ((r.timestamp, r.metric, r.source, r.metadata) for r in records)
     buffer = StringIO()
     csv_writer = csv.writer(buffer)
-    csv_writer.writerows([(r.timestamp, r.metric, r.source, r.metadata) for r in records])
+    csv_writer.writerows(rows)
     return buffer.getvalue().encode()
 
 
+def compact_csv_from_records(records: Iterable[RecordOut]) -> bytes:
+    """Generates the compact csv format from Records.
+
+    The first row lists the sources, every following row is the timestamp difference to the previous record (to 0
+    for the first one), the metric, the index of the source in the first row and the metadata, ex.:
+    web,rq:default
+    1660000000,12,0,
+    0,15,0,
+    1,3000,1,
+    """
+    # a batch lists its sources in order of their first appearance already, just like the first row
+    batch = records if isinstance(records, RecordBatch) else RecordBatch.from_records(records)
+    timestamps = batch.timestamps
+    deltas = (t - previous for t, previous in zip(timestamps, chain((0,), timestamps)))
+    buffer = StringIO()
+    csv_writer = csv.writer(buffer)
+    csv_writer.writerow(batch.sources)
+    csv_writer.writerows(zip(deltas, batch.metrics, batch.source_indexes, batch.metadata))
+    return buffer.getvalue().encode()
+
+
+def encode_payload(
+        records: Iterable[RecordOut],
+        payload_format: str = PAYLOAD_FORMAT_CSV,
+        content_encoding: Optional[str] = None
+) -> Tuple[bytes, Dict[str, str]]:
+    """Returns the upload body for records and the headers describing it"""
+    if payload_format == PAYLOAD_FORMAT_COMPACT:
+        payload = compact_csv_from_records(records)
+    else:
+        payload_format = PAYLOAD_FORMAT_CSV
+        payload = csv_from_records(records)
+    headers = {'Content-Type': CONTENT_TYPES[payload_format]}
+    if content_encoding == CONTENT_ENCODING_GZIP:
+        payload = gzip.compress(payload, compresslevel=GZIP_COMPRESS_LEVEL, mtime=0)
+        headers['Content-Encoding'] = CONTENT_ENCODING_GZIP
+    return payload, headers
+
+
 def dump_prepared_request(req: PreparedRequest, file=None):
     logger.debug("dump_prepared_request")
     print(
         '{}\r\n{}\r\n\r\n{}'.format(
             req.method + ' ' + req.url,
             '\r\n'.join('{}: {}'.format(k, v) for k, v in req.headers.items()),
-            req.body.decode(),
+            f"<{len(req.body)} bytes>" if 'Content-Encoding' in req.headers else req.body.decode(),
         ),
         file=file
     )
@@ -50,17 +112,31 @@ def dump_prepared_request(req: PreparedRequest, file=None):
 def extract_config_response(response: Response) -> Optional[ConfigResponse]:
     logger.debug("extract_config_response")
     try:
-        pf = response.json().get('config', {}).get("publish_frequency")
-        return ConfigResponse(publish_frequency=float(pf)) \
-            if pf and not isinstance(pf, bool) and float(pf) >= 0 \
-            else None
+        config = response.json().get('config', {})
+        pf = config.get("publish_frequency")
+        if not (pf and not isinstance(pf, bool) and float(pf) >= 0):
+            return None
+        content_encoding = config.get('content_encoding')
+        payload_format = config.get('payload_format')
+        return ConfigResponse(
+            publish_frequency=float(pf),
+            content_encoding=content_encoding if content_encoding == CONTENT_ENCODING_GZIP else None,
+            payload_format=payload_format if payload_format in CONTENT_TYPES else PAYLOAD_FORMAT_CSV,
+        )
     except JSONDecodeError as e:
         logger.error(f"extract_config_response - Error parsing response as JSON {e} : {response.text}")
     except AttributeError as e:
         logger.error(f"extract_config_response - Attribute error {e} : {response.text}")
 
 
-def upload_payload(url: str, payload: bytes, dyno: str, session: Optional[Session] = None) -> Optional[Response]:
+def upload_payload(
+        url: str,
+        payload: bytes,
+        dyno: str,
+        session: Optional[Session] = None,
+        timeout: Tuple[float, float] = UPLOAD_TIMEOUT,
+        headers: Optional[Dict[str, str]] = None
+) -> Optional[Response]:
     response = None
     try:
         logger.debug("upload_payload")
@@ -71,7 +147,8 @@ def upload_payload(url: str, payload: bytes, dyno: str, session: Optional[Sessio
         headers = {
             'Content-Type': 'text/csv',
             'User-Agent': f"dynoscale-python;{__version__}",
-            'HTTP_X_DYNO': dyno
+            'HTTP_X_DYNO': dyno,
+            **(headers or {})
         }
         method = 'POST'
         prepared: PreparedRequest = session.prepare_request(
@@ -81,7 +158,7 @@ def upload_payload(url: str, payload: bytes, dyno: str, session: Optional[Sessio
         if logger.isEnabledFor(level=logging.DEBUG):
             dump_prepared_request(prepared)
 
-        response = session.send(prepared)
+        response = session.send(prepared, timeout=timeout)
         req_size = len(prepared.headers) + len(prepared.body)
         if response.ok:
             logger.info(f"Dynoscale successfully uploaded {req_size}bytes with status code {response.status_code}.")
@@ -93,42 +170,154 @@ def upload_payload(url: str, payload: bytes, dyno: str, session: Optional[Sessio
         return response
 
 
+def is_retryable(response: Optional[Response]) -> bool:
+    """Failed uploads worth repeating, the request never made it or the server is overloaded or failing"""
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+
+def retry_delay(retry: int) -> float:
+    """Exponential backoff with full jitter for the n-th retry, starting at 0"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** retry))
+
+
+def upload_with_retries(
+        url: str,
+        payload: bytes,
+        dyno: str,
+        session: Optional[Session] = None,
+        retries: int = UPLOAD_RETRIES,
+        sleep: Callable[[float], None] = time.sleep,
+        headers: Optional[Dict[str, str]] = None
+) -> Optional[Response]:
+    response = upload_payload(url, payload, dyno, session, headers=headers)
+    for retry in range(retries):
+        if not is_retryable(response):
+            break
+        delay = retry_delay(retry)
+        logger.info(f"Dynoscale will retry the upload in {delay:.2f}s.")
+        sleep(delay)
+        response = upload_payload(url, payload, dyno, session, headers=headers)
+    return response
+
+
+class CircuitBreaker:
+    """Stops publishing attempts while Dynoscale keeps failing and probes it again later.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and ``allow`` refuses every attempt for
+    ``reset_timeout`` seconds. Then a single probe is allowed (half open), its success closes the circuit, its failure
+    opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+            self,
+            failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+            clock: Callable[[], float] = time.monotonic
+    ):
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.clock: Callable[[], float] = clock
+        self.state: str = CircuitBreaker.CLOSED
+        self.failures: int = 0
+        self.opened_at: float = 0.0
+
+    def allow(self) -> bool:
+        if self.state == CircuitBreaker.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+            self.state = CircuitBreaker.HALF_OPEN
+            return True
+        return self.state == CircuitBreaker.CLOSED
+
+    def record_success(self):
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CircuitBreaker.OPEN:
+                logger.warning(f"Dynoscale is failing, publishing is paused for {self.reset_timeout}s.")
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = self.clock()
+
+
 class DynoscalePublisher:
+    """Periodically uploads records from the repository to Dynoscale.
+
+    Publisher state lives in memory and is only written through to the repository when it changes, so deciding
+    whether to publish on every tick is a single float comparison. Once the publish looks due, the last attempt and
+    the frequency are read from the repository again, so workers sharing it still publish once per window.
+    """
 
     @property
     def last_publish_attempt(self) -> float:
-        return self.repository.get(KEY_LAST_PUBLISH_ATTEMPT, 0)  # 0 here means never even though it really is 1970
+        return self._last_publish_attempt  # 0 here means never even though it really is 1970
 
     @last_publish_attempt.setter
     def last_publish_attempt(self, t: Optional[float]):
-        self.repository[KEY_LAST_PUBLISH_ATTEMPT] = t
+        t = t if t else 0
+        if t != self._last_publish_attempt:
+            self._last_publish_attempt = t
+            self._next_publish_at = t + self._publish_frequency
+            self.repository[KEY_LAST_PUBLISH_ATTEMPT] = t
 
     @property
     def last_publish_success(self) -> Optional[float]:
-        return self.repository.get(KEY_LAST_PUBLISH_SUCCESS, None)
+        return self._last_publish_success
 
     @last_publish_success.setter
     def last_publish_success(self, t: float):
-        self.repository[KEY_LAST_PUBLISH_SUCCESS] = t
+        if t != self._last_publish_success:
+            self._last_publish_success = t
+            self.repository[KEY_LAST_PUBLISH_SUCCESS] = t
 
     @property
     def publish_frequency(self) -> float:
-        freq = self.repository.get('publish_frequency')
-        if not freq:
-            freq = DEFAULT_PUBLISH_FREQUENCY
-            self.publish_frequency = DEFAULT_PUBLISH_FREQUENCY
-        return freq
+        return self._publish_frequency
 
     @publish_frequency.setter
     def publish_frequency(self, seconds: float):
-        self.repository[KEY_PUBLISH_FREQUENCY] = seconds
+        seconds = seconds if seconds else DEFAULT_PUBLISH_FREQUENCY
+        if seconds != self._publish_frequency:
+            self._publish_frequency = seconds
+            self._next_publish_at = self._last_publish_attempt + seconds
+            self.repository[KEY_PUBLISH_FREQUENCY] = seconds
+
+    @property
+    def content_encoding(self) -> Optional[str]:
+        return self._content_encoding
 
-    def __init__(self):
+    @content_encoding.setter
+    def content_encoding(self, encoding: Optional[str]):
+        if encoding != self._content_encoding:
+            self._content_encoding = encoding
+            self.repository[KEY_CONTENT_ENCODING] = encoding
+
+    @property
+    def payload_format(self) -> str:
+        return self._payload_format
+
+    @payload_format.setter
+    def payload_format(self, payload_format: str):
+        if payload_format != self._payload_format:
+            self._payload_format = payload_format
+            self.repository[KEY_PAYLOAD_FORMAT] = payload_format
+
+    def __init__(self, config: Optional[Config] = None):
         self.logger: logging.Logger = logging.getLogger(f"{__name__}.{DynoscalePublisher.__name__}")
-        self.config: Config = Config()
-        self.repository: DynoscaleRepository = DynoscaleRepository(self.config.repository_path)
+        self.config: Config = config if config is not None else Config()
+        self.repository: Repository = create_repository(self.config.repository_path, self.config.repository_backend)
         self.session: Session = Session()
+        self.circuit_breaker: CircuitBreaker = CircuitBreaker()
         self.pre_publish_hook: Optional[Callable] = None
+        self._last_publish_attempt: float = self.repository.get(KEY_LAST_PUBLISH_ATTEMPT) or 0
+        self._last_publish_success: Optional[float] = self.repository.get(KEY_LAST_PUBLISH_SUCCESS)
+        self._publish_frequency: float = self.repository.get(KEY_PUBLISH_FREQUENCY) or DEFAULT_PUBLISH_FREQUENCY
+        self._next_publish_at: float = self._last_publish_attempt + self._publish_frequency
+        self._content_encoding: Optional[str] = self.repository.get(KEY_CONTENT_ENCODING)
+        self._payload_format: str = self.repository.get(KEY_PAYLOAD_FORMAT) or PAYLOAD_FORMAT_CSV
 
     def tick(self):
         # check if we should publish at all
@@ -143,7 +332,26 @@ class DynoscalePublisher:
             self.publish()
 
     def should_publish(self) -> bool:
-        return self.last_publish_attempt + self.publish_frequency < time.time()
+        if self._next_publish_at >= time.time():
+            return False
+        self._reload_schedule()
+        return self._next_publish_at < time.time()
+
+    def _reload_schedule(self):
+        """Picks up a publish attempt or frequency stored by another publisher sharing the repository"""
+        try:
+            last_publish_attempt = self.repository.get(KEY_LAST_PUBLISH_ATTEMPT) or 0
+            publish_frequency = self.repository.get(KEY_PUBLISH_FREQUENCY) or DEFAULT_PUBLISH_FREQUENCY
+        except Exception as e:
+            self.logger.warning(f"DynoscalePublisher couldn't read the publish schedule from the repository: {e}")
+            return
+        self._last_publish_attempt = max(self._last_publish_attempt, last_publish_attempt)
+        self._publish_frequency = publish_frequency
+        self._next_publish_at = self._last_publish_attempt + self._publish_frequency
+
+    def seconds_until_publish(self) -> float:
+        """Time left until the next publish is due, 0 if it is already due"""
+        return max(0.0, self._next_publish_at - time.time())
 
     def publish(self):
         # First prune the log of old records
@@ -156,23 +364,33 @@ class DynoscalePublisher:
         start_time = time.time()
         # if it is valid, store the time of the last attempt publish, which is now
         self.last_publish_attempt = start_time
-        records = self.repository.get_all_records()
-        # if there are no records to be published exit
-        if not records:
+        # upload the records in bounded batches, so a large backlog never has to fit into memory at once
+        response = None
+        published = 0
+        for records in self.repository.iter_record_batches(PUBLISH_BATCH_SIZE):
+            # while Dynoscale keeps failing, don't even try, records are kept until they are too old
+            if not self.circuit_breaker.allow():
+                self.logger.info("Dynoscale is failing, skipping publish.")
+                return
+            self.logger.info(f"Will publish {len(records)} records to Dynoscale.")
+            payload, headers = encode_payload(records, self.payload_format, self.content_encoding)
+            response = upload_with_retries(self.config.url, payload, self.config.dyno, self.session, headers=headers)
+            # if the upload failed, exit, the rest of the records stays for the next publish
+            if not (isinstance(response, Response) and response.ok):
+                self.circuit_breaker.record_failure()
+                self.logger.warning("Error publishing to Dynoscale.")
+                return
+            self.circuit_breaker.record_success()
+            self.logger.debug("publish - response ok")
+            # since it was successful store the start_time
+            self.last_publish_success = start_time
+            # and delete the successfully uploaded records
+            self.repository.delete_records(records)
+            published += len(records)
+        # if there were no records to be published exit
+        if not published:
             self.logger.info("There is nothing to publish to Dynoscale.")
             return
-        # otherwise, upload the records and
-        self.logger.info(f"Will publish {len(records)} records to Dynoscale.")
-        response = upload_payload(self.config.url, csv_from_records(records), self.config.dyno, self.session)
-        # if the upload failed, exit
-        if not (isinstance(response, Response) and response.ok):
-            self.logger.warning("Error publishing to Dynoscale.")
-            return
-        self.logger.debug("publish - response ok")
-        # since it was successful store the start_time
-        self.last_publish_success = start_time
-        # and delete all successfully uploaded logs
-        self.repository.delete_records(records)
         # and attempt to grab config from the response
         config_response = extract_config_response(response)
         # if we received config response, and it has a new publish_frequency store it
@@ -183,3 +401,6 @@ class DynoscalePublisher:
                 self.logger.info(
                     f"Dynoscale updated publish frequency, next publish in {config_response.publish_frequency}s."
                 )
+            # the encodings Dynoscale accepts, used from the next publish on
+            self.content_encoding = config_response.content_encoding
+            self.payload_format = config_response.payload_format
@@ -1,18 +1,56 @@
+import fcntl
+import json
 import logging
 import math
+import mmap
 import os
+import sqlite3
+import struct
+import threading
 import time
+import zlib
+from abc import abstractmethod
+from array import array
+from collections.abc import MutableMapping, Sequence
 from dataclasses import dataclass
+from enum import Enum
 from os.path import exists
-from typing import Optional, Union, Tuple
+from typing import Optional, Union, Tuple, Iterable, List, Iterator, Dict, Any, Set
 
-from dynoscale.permadict import Permadict
+from dynoscale.permadict import Permadict, PrimitiveCodec
 
 DEFAULT_DYNOSCALE_REPOSITORY_DIRNAME: str = os.getcwd()
 DEFAULT_DYNOSCALE_REPOSITORY_FILENAME: str = 'dynoscale_repo.sqlite3'
+AUTO_VACUUM_INCREMENTAL: int = 2  # value of PRAGMA auto_vacuum in INCREMENTAL mode
+RECLAIM_FREE_PAGES_THRESHOLD: int = 256  # Free pages tolerated before any space is given back to the file system
+RECLAIM_MAX_PAGES: int = 1_024  # Maximum number of pages given back to the file system at once
+PARTITION_SECONDS: int = 60  # Records of every minute are stored in their own table, dropped as a whole once expired
+PARTITION_ROW_BITS: int = 32  # Row id of a DynoscaleRepository record is its partition shifted by these bits | rowid
+PARTITION_ROW_MASK: int = (1 << PARTITION_ROW_BITS) - 1
+READ_BATCH_SIZE: int = 5_000  # Records read at once by get_all_records, like a batch the publisher uploads
+MEMORY_REPOSITORY_CAPACITY: int = 100_000  # Records kept by InMemoryRepository before the oldest ones are dropped
+MMAP_REPOSITORY_CAPACITY: int = 65_536  # Record slots preallocated by MmapRepository, 8 MiB of records
+MMAP_FILE_SUFFIX: str = '.mmap'  # Appended to the repository path, so the segment never overwrites a SQLite file
+MMAP_MAGIC: bytes = b'DYNOLOG1'
+MMAP_HEADER = struct.Struct('<8sQI')  # magic, capacity, length of the json with sources and state that follows
+MMAP_HEADER_SIZE: int = 4_096
+MMAP_RECORD_BODY = struct.Struct('<qqQHBx96s')  # timestamp, metric, row id, source id, metadata length, metadata
+MMAP_RECORD_CRC = struct.Struct('<I')  # crc32 of the body, 0 marks a free or deleted slot
+MMAP_RECORD_SIZE: int = MMAP_RECORD_BODY.size + MMAP_RECORD_CRC.size  # 128
+MMAP_METADATA_SIZE: int = 96  # Longer metadata is truncated
+MMAP_UNKNOWN_SOURCE: int = 0xFFFF  # Source id of records whose source didn't fit into the header
 
 
-@dataclass
+logger = logging.getLogger(__name__)
+
+
+class RepositoryBackend(Enum):
+    SQLITE = 'sqlite'
+    MEMORY = 'memory'
+    MMAP = 'mmap'
+
+
+@dataclass(slots=True)
 class Record:
     timestamp: int
     metric: int
@@ -20,20 +58,453 @@ class Record:
     metadata: str
 
 
-@dataclass
+@dataclass(slots=True)
 class RecordIn(Record):
     pass
 
 
-@dataclass
+@dataclass(slots=True)
 class RecordOut(RecordIn):
     row_id: int
 
 
+class RecordBatch(Sequence):
+    """Records read from a repository, stored in columns instead of one RecordOut per record.
+
+    Timestamps, metrics and row ids are kept in ``array('q')``, the source of every record as an index into
+    ``sources``, which lists them in order of their first appearance. Indexing a batch still returns RecordOut, but
+    encoding or deleting a whole batch reads the columns directly and never creates those objects.
+    """
+    __slots__ = ('timestamps', 'metrics', 'source_indexes', 'sources', 'metadata', 'row_ids', '_source_index')
+
+    def __init__(self):
+        self.timestamps: array = array('q')
+        self.metrics: array = array('q')
+        self.source_indexes: array = array('I')
+        self.sources: List[str] = []
+        self.metadata: List[str] = []
+        self.row_ids: array = array('q')
+        self._source_index: Dict[str, int] = {}
+
+    @classmethod
+    def from_records(cls, records: Iterable[Record]) -> 'RecordBatch':
+        batch = cls()
+        for r in records:
+            batch.append(r.timestamp, r.metric, r.source, r.metadata, getattr(r, 'row_id', 0))
+        return batch
+
+    def append(self, timestamp: int, metric: int, source: str, metadata: str, row_id: int = 0):
+        source_index = self._source_index.get(source)
+        if source_index is None:
+            source_index = self._source_index[source] = len(self.sources)
+            self.sources.append(source)
+        self.timestamps.append(timestamp)
+        self.metrics.append(metric)
+        self.source_indexes.append(source_index)
+        self.metadata.append(metadata)
+        self.row_ids.append(row_id)
+
+    def rows(self) -> Iterator[Tuple[int, int, str, str]]:
+        """Yields (timestamp, metric, source, metadata) of every record"""
+        sources = self.sources
+        return zip(self.timestamps, self.metrics, (sources[i] for i in self.source_indexes), self.metadata)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(len(self))))
+        return RecordOut(
+            self.timestamps[index],
+            self.metrics[index],
+            self.sources[self.source_indexes[index]],
+            self.metadata[index],
+            row_id=self.row_ids[index]
+        )
+
+    def __repr__(self) -> str:
+        return f"{RecordBatch.__name__}({len(self)} records)"
+
+
+def row_id_ranges(row_ids: Iterable[int]) -> List[Tuple[int, int]]:
+    """Collapses row ids into sorted, inclusive (first, last) ranges of consecutive ids"""
+    ranges = []
+    for row_id in sorted(set(row_ids)):
+        if ranges and row_id == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], row_id)
+        else:
+            ranges.append((row_id, row_id))
+    return ranges
+
+
+class Repository(MutableMapping):
+    """Interface of the storage for logs regarding the lifecycle of requests.
+
+    Besides the records, a repository is a small dict-like store for the publisher's state.
+    """
+
+    @abstractmethod
+    def add_records(self, records: Iterable[Record]):
+        """Adds all records at once"""
+
+    @abstractmethod
+    def iter_record_batches(self, batch_size: int) -> Iterator[RecordBatch]:
+        """Yields all records ordered by timestamp in batches of at most batch_size records, the records of a batch
+        can be deleted before the next one is requested."""
+
+    @abstractmethod
+    def delete_records_before(self, t: float):
+        """Deletes all records with a timestamp before t"""
+
+    @abstractmethod
+    def _delete_row_id_ranges(self, ranges: List[Tuple[int, int]]):
+        """Deletes records with row ids in the inclusive (first, last) ranges"""
+
+    def add_record(self, record: Record):
+        self.add_records((record,))
+
+    def get_all_records(self) -> Tuple[RecordOut]:
+        return tuple(record for batch in self.iter_record_batches(READ_BATCH_SIZE) for record in batch)
+
+    def delete_records(self, records: Union[RecordBatch, Tuple[RecordOut]]):
+        if isinstance(records, RecordBatch):
+            row_ids = records.row_ids
+        elif records and isinstance(records, Tuple) and isinstance(records[0], RecordOut):
+            row_ids = (r.row_id for r in records if isinstance(getattr(r, 'row_id', None), int))
+        else:
+            self.logger.debug(f"delete_records - Attempting to delete non-iterable: {records}")
+            return
+        self.logger.debug(f"delete_records - Deleting {len(records)} records.")
+        # uploaded records are mostly consecutive rows, so this is usually a single range
+        self._delete_row_id_ranges(row_id_ranges(row_ids))
+
+    def delete_records_older_than(self, seconds: float):
+        self.logger.debug(f"delete_records_older_than {seconds} seconds")
+        self.delete_records_before(time.time() - seconds)
+
+
+class _MemoryStore:
+    """Records and state of all InMemoryRepository instances with the same path"""
+
+    def __init__(self, capacity: int):
+        self.lock: threading.Lock = threading.Lock()
+        self.records: Dict[int, RecordOut] = {}  # insertion ordered, so the first one is the oldest
+        self.state: Dict[Any, Any] = {}
+        self.capacity: int = capacity
+        self.next_row_id: int = 1
+
+
+class InMemoryRepository(Repository):
+    """Repository keeping records and state only in memory, nothing survives the process.
+
+    Instances created with the same path in one process share their records and state, like connections to the same
+    SQLite file would. At most capacity records are kept, once full the oldest record is dropped for every new one.
+    """
+    _stores: Dict[Any, _MemoryStore] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(
+            self,
+            path: Optional[Union[str, bytes, os.PathLike]] = None,
+            capacity: int = MEMORY_REPOSITORY_CAPACITY
+    ):
+        self.logger: logging.Logger = logging.getLogger(f"{__name__}.{InMemoryRepository.__name__}")
+        self.filename = path
+        with InMemoryRepository._stores_lock:
+            # keyed by pid too, a forked child must not publish the records of its parent
+            key = (os.getpid(), path)
+            self._store: _MemoryStore = InMemoryRepository._stores.setdefault(key, _MemoryStore(capacity))
+
+    def add_records(self, records: Iterable[Record]):
+        store = self._store
+        with store.lock:
+            for r in records:
+                row_id = store.next_row_id
+                store.records[row_id] = RecordOut(r.timestamp, r.metric, r.source, r.metadata, row_id=row_id)
+                store.next_row_id += 1
+            while len(store.records) > store.capacity:
+                del store.records[next(iter(store.records))]
+
+    def iter_record_batches(self, batch_size: int) -> Iterator[RecordBatch]:
+        with self._store.lock:
+            records = sorted(self._store.records.values(), key=lambda r: (r.timestamp, r.row_id))
+        for start in range(0, len(records), batch_size):
+            yield RecordBatch.from_records(records[start:start + batch_size])
+
+    def delete_records_before(self, t: float):
+        store = self._store
+        with store.lock:
+            for row_id in [row_id for row_id, r in store.records.items() if r.timestamp < math.ceil(t)]:
+                del store.records[row_id]
+
+    def _delete_row_id_ranges(self, ranges: List[Tuple[int, int]]):
+        store = self._store
+        with store.lock:
+            for first, last in ranges:
+                if last - first < len(store.records):
+                    for row_id in range(first, last + 1):
+                        store.records.pop(row_id, None)
+                else:
+                    for row_id in [row_id for row_id in store.records if first <= row_id <= last]:
+                        del store.records[row_id]
+
+    def __getitem__(self, key):
+        return self._store.state[key]
+
+    def __setitem__(self, key, value):
+        self._store.state[key] = value
+
+    def __delitem__(self, key):
+        del self._store.state[key]
+
+    def __iter__(self):
+        return iter(list(self._store.state))
+
+    def __len__(self):
+        return len(self._store.state)
+
+
+def truncate_metadata(metadata: str, size: int = MMAP_METADATA_SIZE) -> bytes:
+    """Encodes metadata to at most size bytes of utf-8 without splitting a character"""
+    encoded = metadata.encode()
+    return encoded if len(encoded) <= size else encoded[:size].decode(errors='ignore').encode()
+
+
+class _MmapSegment:
+    """Preallocated, memory-mapped file of fixed size record slots shared by all MmapRepository instances of a process
+    with the same path.
+
+    The record with row id n lives in slot n % capacity, so once the segment is full every new record replaces the
+    oldest one. The header holds the source dictionary and the publisher state as json. On open all slots are
+    scanned, records with a valid crc are live and the next row id continues after the highest one.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.logger: logging.Logger = logging.getLogger(f"{__name__}.{MmapRepository.__name__}")
+        self.lock: threading.Lock = threading.Lock()
+        self.path: str = path
+        self.fd: int = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # a single writer, another process appending to the same slots would corrupt them
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.fd)
+            raise
+        size = MMAP_HEADER_SIZE + capacity * MMAP_RECORD_SIZE
+        old_size = os.fstat(self.fd).st_size
+        existed = old_size == size
+        if not existed:
+            if old_size:
+                self.logger.warning(f"MmapRepository resets {self.path} and drops its records, its size is {old_size}"
+                                    f" bytes but a capacity of {capacity} records needs {size} bytes.")
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, size)
+        self.mm: mmap.mmap = mmap.mmap(self.fd, size)
+        self.capacity: int = capacity
+        self.sources: List[str] = []
+        self.state: Dict[str, Any] = {}
+        self.live: Dict[int, int] = {}  # row id -> timestamp of every live record
+        self.next_row_id: int = 1
+        header_valid = existed and self._read_header()
+        if not header_valid:
+            self.mm[:MMAP_HEADER_SIZE] = bytes(MMAP_HEADER_SIZE)
+            self.write_header()
+        if existed:
+            # records are validated by their own crc, they survive a header that was lost
+            self._recover(sources_lost=not header_valid)
+        self.source_ids: Dict[str, int] = {source: i for i, source in enumerate(self.sources)}
+
+    def _read_header(self) -> bool:
+        magic, capacity, length = MMAP_HEADER.unpack_from(self.mm, 0)
+        if magic != MMAP_MAGIC or capacity != self.capacity or length > MMAP_HEADER_SIZE - MMAP_HEADER.size:
+            self.logger.warning(f"MmapRepository reinitializes {self.path}, it isn't a segment of this capacity.")
+            return False
+        try:
+            header = json.loads(bytes(self.mm[MMAP_HEADER.size:MMAP_HEADER.size + length]) or b'{}')
+            sources, state = header.get('sources', []), header.get('state', {})
+            if not (isinstance(sources, list) and isinstance(state, dict)):
+                raise ValueError("unexpected header structure")
+        except (ValueError, AttributeError) as e:
+            self.logger.warning(f"MmapRepository reinitializes the header of {self.path}, it is corrupted: {e}")
+            return False
+        self.sources = sources
+        self.state = state
+        return True
+
+    def write_header(self) -> bool:
+        header = json.dumps({'sources': self.sources, 'state': self.state}).encode()
+        if len(header) > MMAP_HEADER_SIZE - MMAP_HEADER.size:
+            return False
+        # the json first, the length that makes it valid last
+        self.mm[MMAP_HEADER.size:MMAP_HEADER.size + len(header)] = header
+        MMAP_HEADER.pack_into(self.mm, 0, MMAP_MAGIC, self.capacity, len(header))
+        return True
+
+    def _recover(self, sources_lost: bool = False):
+        for slot in range(self.capacity):
+            record = self.read_slot(slot)
+            if record is None:
+                continue
+            if sources_lost:
+                # the source ids point into the lost dictionary, new sources must not be mistaken for them
+                self.rewrite_source(slot, MMAP_UNKNOWN_SOURCE)
+            self.live[record.row_id] = record.timestamp
+        self.next_row_id = max(self.live, default=0) + 1
+        self.logger.info(f"MmapRepository recovered {len(self.live)} records from {self.path}.")
+
+    def source_id(self, source: str) -> int:
+        source_id = self.source_ids.get(source)
+        if source_id is None:
+            if len(self.sources) >= MMAP_UNKNOWN_SOURCE:
+                return MMAP_UNKNOWN_SOURCE
+            self.sources.append(source)
+            if not self.write_header():
+                self.sources.pop()
+                self.logger.warning(f"MmapRepository has no room for source {source}, it will be stored empty.")
+                return MMAP_UNKNOWN_SOURCE
+            source_id = self.source_ids[source] = len(self.sources) - 1
+        return source_id
+
+    def append(self, record: Record):
+        row_id = self.next_row_id
+        self.next_row_id += 1
+        metadata = truncate_metadata(record.metadata)
+        body = MMAP_RECORD_BODY.pack(
+            record.timestamp, record.metric, row_id, self.source_id(record.source), len(metadata), metadata
+        )
+        offset = MMAP_HEADER_SIZE + (row_id % self.capacity) * MMAP_RECORD_SIZE
+        self.live.pop(row_id - self.capacity, None)  # the oldest record in this slot, if there still is one
+        self.mm[offset:offset + MMAP_RECORD_BODY.size] = body
+        MMAP_RECORD_CRC.pack_into(self.mm, offset + MMAP_RECORD_BODY.size, zlib.crc32(body))
+        self.live[row_id] = record.timestamp
+
+    def rewrite_source(self, slot: int, source_id: int):
+        offset = MMAP_HEADER_SIZE + slot * MMAP_RECORD_SIZE
+        timestamp, metric, row_id, _, metadata_length, metadata = MMAP_RECORD_BODY.unpack_from(self.mm, offset)
+        body = MMAP_RECORD_BODY.pack(timestamp, metric, row_id, source_id, metadata_length, metadata)
+        self.mm[offset:offset + MMAP_RECORD_BODY.size] = body
+        MMAP_RECORD_CRC.pack_into(self.mm, offset + MMAP_RECORD_BODY.size, zlib.crc32(body))
+
+    def read_slot(self, slot: int) -> Optional[RecordOut]:
+        offset = MMAP_HEADER_SIZE + slot * MMAP_RECORD_SIZE
+        body = self.mm[offset:offset + MMAP_RECORD_BODY.size]
+        crc, = MMAP_RECORD_CRC.unpack_from(self.mm, offset + MMAP_RECORD_BODY.size)
+        if crc == 0 or crc != zlib.crc32(body):
+            return None
+        timestamp, metric, row_id, source_id, metadata_length, metadata = MMAP_RECORD_BODY.unpack(body)
+        source = self.sources[source_id] if source_id < len(self.sources) else ''
+        return RecordOut(timestamp, metric, source, metadata[:metadata_length].decode(errors='ignore'), row_id=row_id)
+
+    def read(self, row_id: int) -> Optional[RecordOut]:
+        record = self.read_slot(row_id % self.capacity)
+        return record if record is not None and record.row_id == row_id else None
+
+    def delete(self, row_id: int):
+        if self.live.pop(row_id, None) is not None:
+            offset = MMAP_HEADER_SIZE + (row_id % self.capacity) * MMAP_RECORD_SIZE + MMAP_RECORD_BODY.size
+            MMAP_RECORD_CRC.pack_into(self.mm, offset, 0)
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        os.close(self.fd)  # releases the lock too
+
+
+class MmapRepository(Repository):
+    """Repository appending fixed size binary records to a preallocated, memory-mapped segment file.
+
+    Appending a record packs it with struct straight into the mapped file, without SQL or pickle. The records survive
+    a restart of the process, only one process at a time can open the segment.
+    """
+    _segments: Dict[Any, _MmapSegment] = {}
+    _segments_lock = threading.Lock()
+
+    def __init__(self, path: Optional[Union[str, bytes, os.PathLike]] = None, capacity: int = MMAP_REPOSITORY_CAPACITY):
+        self.logger: logging.Logger = logging.getLogger(f"{__name__}.{MmapRepository.__name__}")
+        self.filename = os.fsdecode(path if path else os.path.join(
+            DEFAULT_DYNOSCALE_REPOSITORY_DIRNAME,
+            DEFAULT_DYNOSCALE_REPOSITORY_FILENAME + MMAP_FILE_SUFFIX
+        ))
+        with MmapRepository._segments_lock:
+            key = (os.getpid(), self.filename)
+            segment = MmapRepository._segments.get(key)
+            if segment is None:
+                segment = MmapRepository._segments[key] = _MmapSegment(self.filename, capacity)
+        self._segment: _MmapSegment = segment
+
+    def add_records(self, records: Iterable[Record]):
+        segment = self._segment
+        with segment.lock:
+            for record in records:
+                segment.append(record)
+
+    def iter_record_batches(self, batch_size: int) -> Iterator[RecordBatch]:
+        segment = self._segment
+        with segment.lock:
+            row_ids = sorted(segment.live, key=lambda row_id: (segment.live[row_id], row_id))
+        for start in range(0, len(row_ids), batch_size):
+            with segment.lock:
+                batch = RecordBatch.from_records(
+                    filter(None, (segment.read(row_id) for row_id in row_ids[start:start + batch_size]))
+                )
+            if batch:
+                yield batch
+
+    def delete_records_before(self, t: float):
+        segment = self._segment
+        with segment.lock:
+            for row_id in [row_id for row_id, timestamp in segment.live.items() if timestamp < math.ceil(t)]:
+                segment.delete(row_id)
+
+    def _delete_row_id_ranges(self, ranges: List[Tuple[int, int]]):
+        segment = self._segment
+        with segment.lock:
+            for first, last in ranges:
+                if last - first < len(segment.live):
+                    row_ids = range(first, last + 1)
+                else:
+                    row_ids = [row_id for row_id in segment.live if first <= row_id <= last]
+                for row_id in row_ids:
+                    segment.delete(row_id)
+
+    def close(self):
+        """Flushes the segment to disk and lets another process open it, for all instances sharing it"""
+        with MmapRepository._segments_lock:
+            key = (os.getpid(), self.filename)
+            if MmapRepository._segments.get(key) is self._segment:
+                del MmapRepository._segments[key]
+                with self._segment.lock:
+                    self._segment.close()
+
+    def __getitem__(self, key):
+        return self._segment.state[key]
+
+    def __setitem__(self, key, value):
+        segment = self._segment
+        with segment.lock:
+            segment.state[key] = value
+            if not segment.write_header():
+                del segment.state[key]
+                raise ValueError(f"MmapRepository header has no room for {key}.")
+
+    def __delitem__(self, key):
+        segment = self._segment
+        with segment.lock:
+            del segment.state[key]
+            segment.write_header()
+
+    def __iter__(self):
+        return iter(list(self._segment.state))
+
+    def __len__(self):
+        return len(self._segment.state)
+
+
 # noinspection SqlNoDataSourceInspection
 # noinspection SqlResolve
-class DynoscaleRepository(Permadict):
-    """Storage for logs regarding the lifecycle of requests"""
+class DynoscaleRepository(Permadict, Repository):
+    """Storage for logs regarding the lifecycle of requests in a SQLite file"""
 
     def __init__(self, path: Optional[Union[str, bytes, os.PathLike]] = None, **kwargs):
         self.logger: logging.Logger = logging.getLogger(f"{__name__}.{DynoscaleRepository.__name__}")
@@ -43,56 +514,214 @@ class DynoscaleRepository(Permadict):
             DEFAULT_DYNOSCALE_REPOSITORY_FILENAME
             )
         self.db_existed = exists(db_filename)
-        super().__init__(db_filename)
-        self._create_log_table()
+        # the state is only floats, ints and strings, so a tampered file can't get anything unpickled
+        super().__init__(db_filename, codec=PrimitiveCodec(allow_pickle=False))
+        self._drop_undecodable_state()
+        self._enable_incremental_vacuum()
+        self._known_partitions: Set[int] = set()  # partitions this connection created or inserted into
+        self._migrate_unpartitioned_logs()
         self.logger.info(f"Dynoscale {'opened' if self.db_existed else 'created'} repository {self.filename}.")
 
-    def _create_log_table(self):
-        self.logger.debug("_create_log_table")
+    def _drop_undecodable_state(self):
+        """Removes state the codec can't read, like values pickled by earlier versions, so the defaults apply"""
         with self.cursor() as cur:
-            cur.execute(
-                'CREATE TABLE IF NOT EXISTS logs(timestamp INTEGER, metric INTEGER, source STRING, metadata STRING)'
-            )
+            cur.execute("SELECT name, object FROM dict")
+            rows = cur.fetchall()
+        for key, obj in rows:
+            try:
+                self.codec.decode(obj)
+            except ValueError:
+                self.logger.warning(f"DynoscaleRepository drops state {key}, it isn't stored as a primitive value.")
+                del self[key]
 
-    def add_record(self, record: Record):
-        self.logger.debug(f"add_record ({record.timestamp},{record.metric},{record.source},{record.metadata})")
+    def _enable_incremental_vacuum(self):
+        """Switches the database to incremental auto vacuum, rebuilding it once if it was created without it"""
         with self.cursor() as cur:
-            cur.execute(
-                'INSERT INTO logs (timestamp, metric, source, metadata) VALUES (?,?,?,?)',
-                (record.timestamp, record.metric, record.source, record.metadata)
-            )
+            cur.execute('PRAGMA auto_vacuum')
+            if cur.fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+                return
+            self.logger.debug("_enable_incremental_vacuum")
+            try:
+                cur.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+                cur.execute('VACUUM')  # auto_vacuum of an existing database only changes when it is rebuilt
+            except sqlite3.OperationalError as e:
+                self.logger.warning(f"DynoscaleRepository couldn't enable incremental vacuum: {e}")
 
-    def get_all_records(self) -> Tuple[RecordOut]:
-        self.logger.debug("get_all_records")
+    def _migrate_unpartitioned_logs(self):
+        """Moves records of the single log table used before partitioning into partitions"""
+        self.logger.debug("_migrate_unpartitioned_logs")
         with self.cursor() as cur:
-            cur.execute("SELECT rowid, timestamp, metric, source, metadata FROM logs ORDER BY timestamp")
-            rows = cur.fetchall()
-            return tuple(RecordOut(row_id=r[0], timestamp=r[1], metric=r[2], source=r[3], metadata=r[4]) for r in rows)
+            cur.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'logs')")
+            if not cur.fetchone()[0]:
+                return
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute('SELECT DISTINCT timestamp / (?) FROM logs', (PARTITION_SECONDS,))
+            for bucket, in cur.fetchall():
+                self._create_partition(cur, bucket)
+                cur.execute(
+                    f'INSERT INTO "logs_{bucket}" SELECT timestamp, metric, source, metadata FROM logs '
+                    'WHERE timestamp / (?) = (?) ORDER BY rowid',
+                    (PARTITION_SECONDS, bucket)
+                )
+            cur.execute('DROP TABLE logs')
+        self.logger.info("DynoscaleRepository moved its records into partitions.")
 
-    def delete_records(self, records: Tuple[RecordOut]):
-        if not (records and isinstance(records, Tuple) and isinstance(records[0], RecordOut)):
-            self.logger.debug(f"delete_records - Attempting to delete non-iterable: {records}")
+    @staticmethod
+    def _create_partition(cur: sqlite3.Cursor, bucket: int):
+        cur.execute(
+            f'CREATE TABLE IF NOT EXISTS "logs_{bucket}"'
+            '(timestamp INTEGER, metric INTEGER, source STRING, metadata STRING)'
+        )
+        cur.execute(f'CREATE INDEX IF NOT EXISTS "ix_logs_{bucket}_timestamp" ON "logs_{bucket}" (timestamp)')
+
+    def _partitions(self) -> List[int]:
+        """Buckets of all partitions, oldest first"""
+        with self.cursor() as cur:
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'logs_*'")
+            names = [name for name, in cur.fetchall()]
+        buckets = []
+        for name in names:
+            try:
+                buckets.append(int(name[len('logs_'):]))
+            except ValueError:
+                pass
+        return sorted(buckets)
+
+    def add_records(self, records: Iterable[Record]):
+        """Adds all records in a single transaction, each into the partition of its timestamp"""
+        partitions: Dict[int, list] = {}
+        count = 0
+        for r in records:
+            partitions.setdefault(r.timestamp // PARTITION_SECONDS, []).append(
+                (r.timestamp, r.metric, r.source, r.metadata)
+            )
+            count += 1
+        if not partitions:
             return
-        self.logger.debug(f"delete_records - Deleting {len(records)} records.")
-        row_id_tuples = [(r.row_id,) for r in records if hasattr(r, 'row_id')]
+        self.logger.debug("add_records (%s records)", count)
+        try:
+            self._insert_into_partitions(partitions)
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            # another connection dropped a partition this one knew, create whatever is missing and try once more
+            self._known_partitions.clear()
+            self._insert_into_partitions(partitions)
+
+    def _insert_into_partitions(self, partitions: Dict[int, list]):
         with self.cursor() as cur:
+            cur.execute('BEGIN IMMEDIATE')
+            for bucket, rows in partitions.items():
+                if bucket not in self._known_partitions:
+                    self._create_partition(cur, bucket)
+                    self._known_partitions.add(bucket)
+                cur.executemany(
+                    f'INSERT INTO "logs_{bucket}" (timestamp, metric, source, metadata) VALUES (?,?,?,?)', rows
+                )
+
+    def iter_record_batches(self, batch_size: int) -> Iterator[RecordBatch]:
+        """Yields all records ordered by timestamp in batches of at most batch_size records.
+
+        Partitions are read oldest first. Every batch is a separate query per partition continuing after the last
+        record of the previous one, so no cursor stays open between batches and the records of a batch can be
+        deleted before the next one is read.
+        """
+        self.logger.debug("iter_record_batches (%s)", batch_size)
+        batch = RecordBatch()
+        for bucket in self._partitions():
+            last = (-math.inf, -1)
+            while True:
+                limit = batch_size - len(batch)
+                try:
+                    with self.cursor() as cur:
+                        cur.execute(
+                            f'SELECT rowid, timestamp, metric, source, metadata FROM "logs_{bucket}" '
+                            'WHERE (timestamp, rowid) > (?, ?) ORDER BY timestamp, rowid LIMIT ?',
+                            (*last, limit)
+                        )
+                        rows = cur.fetchall()
+                except sqlite3.OperationalError:
+                    break  # the partition was dropped meanwhile
+                for rowid, timestamp, metric, source, metadata in rows:
+                    batch.append(timestamp, metric, source, metadata, bucket << PARTITION_ROW_BITS | rowid)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = RecordBatch()
+                if len(rows) < limit:
+                    break
+                last = (rows[-1][1], rows[-1][0])
+        if batch:
+            yield batch
+
+    def _delete_row_id_ranges(self, ranges: List[Tuple[int, int]]):
+        partitions: Dict[int, List[Tuple[int, int]]] = {}
+        for first, last in ranges:
+            for bucket in range(first >> PARTITION_ROW_BITS, (last >> PARTITION_ROW_BITS) + 1):
+                partitions.setdefault(bucket, []).append((
+                    max(first - (bucket << PARTITION_ROW_BITS), 0),
+                    min(last - (bucket << PARTITION_ROW_BITS), PARTITION_ROW_MASK)
+                ))
+        for bucket, local_ranges in partitions.items():
             try:
-                cur.executemany('DELETE FROM logs WHERE rowid = (?)', row_id_tuples)
+                with self.cursor() as cur:
+                    cur.execute('BEGIN IMMEDIATE')
+                    if len(local_ranges) == 1:
+                        # a partition uploaded as a whole is dropped instead of deleting it row by row
+                        cur.execute(
+                            f'SELECT EXISTS (SELECT 1 FROM "logs_{bucket}" WHERE rowid < (?) OR rowid > (?))',
+                            local_ranges[0]
+                        )
+                        if not cur.fetchone()[0]:
+                            cur.execute(f'DROP TABLE "logs_{bucket}"')
+                            self._known_partitions.discard(bucket)
+                            continue
+                    cur.executemany(f'DELETE FROM "logs_{bucket}" WHERE rowid BETWEEN (?) AND (?)', local_ranges)
             except Exception as e:
                 self.logger.warning(f"DynoscaleRepository ran into an issue while deleting records {e}")
-        self.__vacuum()
+        self.__reclaim_space()
 
     def delete_records_before(self, t: float):
+        """Drops partitions that end before t, only the partition t falls into is deleted from row by row"""
         self.logger.debug(f"delete_records_before {t}")
+        cutoff = math.ceil(t)
+        for bucket in self._partitions():
+            if bucket * PARTITION_SECONDS >= cutoff:
+                break
+            with self.cursor() as cur:
+                if (bucket + 1) * PARTITION_SECONDS <= cutoff:
+                    cur.execute(f'DROP TABLE IF EXISTS "logs_{bucket}"')
+                    self._known_partitions.discard(bucket)
+                else:
+                    try:
+                        cur.execute(f'DELETE FROM "logs_{bucket}" WHERE timestamp < (?)', (cutoff,))
+                    except sqlite3.OperationalError:
+                        pass  # the partition was dropped meanwhile
+        self.__reclaim_space()
+
+    def __reclaim_space(self):
+        """Gives at most RECLAIM_MAX_PAGES free pages back to the file system, once there are enough of them"""
         with self.cursor() as cur:
-            cur.execute('DELETE FROM logs WHERE timestamp < (?)', (math.ceil(t),))
-        self.__vacuum()
+            cur.execute('PRAGMA freelist_count')
+            free_pages = cur.fetchone()[0]
+            if free_pages < RECLAIM_FREE_PAGES_THRESHOLD:
+                return
+            self.logger.debug(f"__reclaim_space - {free_pages} free pages")
+            # execute() only steps the pragma once which frees a single page, executescript() runs it to completion
+            cur.executescript(f'PRAGMA incremental_vacuum({RECLAIM_MAX_PAGES});')
 
-    def delete_records_older_than(self, seconds: float):
-        self.logger.debug(f"delete_records_older_than {seconds} seconds")
-        self.delete_records_before(time.time() - seconds)
 
-    def __vacuum(self):
-        self.logger.debug("__vacuum")
-        with self.cursor() as cur:
-            cur.execute('VACUUM')
+def create_repository(
+        path: Optional[Union[str, bytes, os.PathLike]] = None,
+        backend: RepositoryBackend = RepositoryBackend.SQLITE
+) -> Repository:
+    """Opens the repository at path with the requested backend"""
+    if backend is RepositoryBackend.MEMORY:
+        return InMemoryRepository(path)
+    if backend is RepositoryBackend.MMAP:
+        mmap_path = os.fsdecode(path) + MMAP_FILE_SUFFIX if path else None
+        try:
+            return MmapRepository(mmap_path)
+        except BlockingIOError:
+            logger.warning(f"Another process writes to {mmap_path}, records of this one are kept in memory.")
+            return InMemoryRepository(path)
+    return DynoscaleRepository(path)
@@ -1,3 +1,4 @@
+import itertools
 import math
 import random
 import re
@@ -88,6 +89,34 @@ def get_int_from_headers(
         return result
 
 
+def get_int_from_environ(environ: dict, key: str, default: Optional[int] = None) -> Optional[int]:
+    """
+    Returns an int stored in a WSGI environ under `key`, or default if it is missing or not an int.
+
+    WSGI servers store headers under their canonical CGI names (ex.: HTTP_X_REQUEST_START), so this is a single
+    dict lookup, the case-insensitive scan of the whole environ only happens when the canonical key is missing.
+    :param environ: WSGI environ dictionary
+    :param key: Canonical (upper case) CGI name of the header
+    :param default: Value returned when the header is missing or can't be parsed
+    :return: Parsed int or default
+    """
+    value = environ.get(key)
+    if value is None:
+        key_length, upper_key = len(key), key.upper()
+        for k, v in environ.items():
+            if isinstance(k, str) and len(k) == key_length and k.upper() == upper_key:
+                value = v
+                break
+        else:
+            return default
+    if not isinstance(value, (str, int, float)):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
 def get_int_from_bytestring_headers(
         headers: List[Tuple[bytes, bytes]],
         key: str, default: Optional[int] = None
@@ -109,6 +138,32 @@ def get_int_from_bytestring_headers(
         return result
 
 
+def get_int_from_asgi_headers(
+        headers: List[Tuple[bytes, bytes]],
+        key: bytes, default: Optional[int] = None
+) -> Optional[int]:
+    """
+    Returns an int from the first raw ASGI header named `key`, or default if it is missing or not an int.
+
+    Works on the (bytes, bytes) pairs as they are, names are compared case-insensitively without decoding and
+    the scan stops at the first match, so no intermediate strings are created for the other headers.
+    :param headers: Raw ASGI headers, an iterable of [name, value] pairs of bytes
+    :param key: Lower case header name (ex.: b'x-request-start')
+    :param default: Value returned when the header is missing or can't be parsed
+    :return: Parsed int or default
+    """
+    key_length = len(key)
+    try:
+        for header in headers:
+            name = header[0]
+            if isinstance(name, bytes) and len(name) == key_length and (name == key or name.lower() == key):
+                value = header[1]
+                return int(value) if isinstance(value, bytes) else default
+    except (TypeError, IndexError, ValueError):
+        pass
+    return default
+
+
 def get_str_from_headers(
         headers: Union[dict, List[Tuple[str, str]]],
         key: str, default: Optional[str] = None
@@ -121,6 +176,17 @@ def get_str_from_headers(
     return value if isinstance(value, str) else default
 
 
+class Sampler:
+    """Callable returning True once every `n` calls and never if `n` is less than 1, safe to share between threads"""
+
+    def __init__(self, n: int = 0):
+        self.n: int = n
+        self._calls = itertools.count(1)
+
+    def __call__(self) -> bool:
+        return self.n > 0 and next(self._calls) % self.n == 0
+
+
 def pseudo_normal_random(lower: int = 0, upper: int = 100, quality: int = 10) -> int:
     """Generate a value between min-max in a normal distribution"""
     values = sum([random.randint(lower, upper) for _ in range(quality)])
@@ -8,7 +8,7 @@ import redis
 from rq import Queue
 
 from dynoscale.config import Config, get_redis_urls_from_environ
-from dynoscale.repository import DynoscaleRepository, Record
+from dynoscale.repository import Repository, Record, create_repository
 from dynoscale.utils import epoch_s
 
 logger = logging.getLogger(__name__)
@@ -62,14 +62,17 @@ def get_queue_time_records() -> Iterable[Record]:
 
 
 class DynoscaleRqLogger:
-    def __init__(self):
+    def __init__(self, repository: Optional[Repository] = None):
         self.logger: logging.Logger = logging.getLogger(f"{__name__}.{DynoscaleRqLogger.__name__}")
         self.logger.debug("DynoscaleRqLogger initializing...")
         self.config = Config()
         if not self.config.is_rq_available:
             self.logger.warning("Rq not available, DynoscaleRqLogger will not initialize.")
             return
-        self.repository = DynoscaleRepository(self.config.repository_path)
+        # share the publisher's connection when given one, rather than opening a second one to the same file
+        self.repository = repository if repository is not None else create_repository(
+            self.config.repository_path, self.config.repository_backend
+        )
 
     def log_queue_times(self):
         try:  # Under no circumstances should log_queue_times crash
@@ -78,7 +81,7 @@ class DynoscaleRqLogger:
                 return
             for record in get_queue_time_records():
                 try:
-                    self.logger.debug(f"DynoscaleRqLogger adding record: {record}")
+                    self.logger.debug("DynoscaleRqLogger adding record: %s", record)
                     self.repository.add_record(record)
                 except Exception as e:
                     logger.warning(f"DynoscaleRqLogger couldn't add record: {record} exception: {e} ")
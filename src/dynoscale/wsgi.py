@@ -1,10 +1,11 @@
 import logging
 from typing import Callable
 
-from dynoscale.agent import DynoscaleAgent
+from dynoscale.agent import DynoscaleAgent, get_agent
 from dynoscale.config import Config
-from dynoscale.constants import HTTP_X_REQUEST_START
-from dynoscale.utils import epoch_ms, get_int_from_headers, fake_request_start_ms
+from dynoscale.constants import HTTP_X_REQUEST_START, TRACE_LOGGER_NAME
+from dynoscale.hooks.gunicorn import collector_sender
+from dynoscale.utils import epoch_ms, get_int_from_environ, fake_request_start_ms, Sampler
 
 
 class DynoscaleWsgiApp:
@@ -15,13 +16,16 @@ class DynoscaleWsgiApp:
         self.__app = app
 
         self.config = Config()
+        self.trace_logger: logging.Logger = logging.getLogger(TRACE_LOGGER_NAME)
+        self.should_trace = Sampler(self.config.trace_sample_rate)
         if self.config.is_not_valid:
             self.logger.warning(
                 f"{DynoscaleWsgiApp.__name__} will not "
                 f"initialize {DynoscaleAgent.__name__} with invalid config: {self.config}."
                 )
             return  # User app will keep running, but queue times won't be logged
-        self.ds_agent = DynoscaleAgent()
+        # a collector inherited from the Gunicorn master logs the queue times, no agent needed in the worker
+        self.ds_agent = collector_sender() or get_agent()
         self.logger.info(f"{DynoscaleWsgiApp.__name__} started in {self.config.run_mode_name} mode.")
 
     def __call__(self, environ: dict, start_response: Callable):
@@ -38,9 +42,10 @@ class DynoscaleWsgiApp:
     def log_queue_time(self, environ):
         # Under no circumstances should we ever stop user app from receiving the request
         try:
-            self.logger.debug(f"log_queue_time (e:{environ})")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("log_queue_time (e:%s)", environ)
             log_start = epoch_ms()
-            http_x_request_start = get_int_from_headers(
+            http_x_request_start = get_int_from_environ(
                 environ,
                 HTTP_X_REQUEST_START,
                 fake_request_start_ms() if self.config.is_dev_mode else None
@@ -48,9 +53,14 @@ class DynoscaleWsgiApp:
             if http_x_request_start is not None:
                 req_queue_time: int = log_start - http_x_request_start
                 req_timestamp = int(log_start / 1_000)
-                self.logger.debug(f"log_queue_time - Logging queue time {req_queue_time}")
+                self.logger.debug("log_queue_time - Logging queue time %s", req_queue_time)
                 self.ds_agent.log_queue_time(req_timestamp, req_queue_time)
             else:
                 self.logger.info("Can not calculate queue time.")
+            if self.should_trace():
+                self.trace_logger.info(
+                    "%s request start: %s, logged at: %s, environ: %s",
+                    DynoscaleWsgiApp.__name__, http_x_request_start, log_start, environ
+                )
         except Exception as e:
-            self.logger.error(f"Unknown error while attempting to log a queue time: {e}")
+            self.logger.error("Unknown error while attempting to log a queue time: %s", e)
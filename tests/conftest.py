@@ -17,6 +17,13 @@ def on_exit_tear_down_threads():
         thread.join(0)
 
 
+@pytest.fixture(autouse=True)
+def fresh_process_agents(monkeypatch):
+    """Every test gets its own process wide agents, they'd otherwise keep the config of the first test using them"""
+    from dynoscale import agent
+    monkeypatch.setattr(agent, '_agents', {})
+
+
 @pytest.fixture
 def env_invalid_missing_dyno(env_del_dyno, env_set_data_dir_name, env_set_data_file_name):
     yield
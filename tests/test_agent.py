@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import os
 import time
 from pprint import pprint
 
@@ -8,6 +9,7 @@ import requests
 import responses
 
 from dynoscale.constants import (
+    ENV_DYNOSCALE_DATA_DIR_NAME,
     ENV_REDISGREEN_URL,
     ENV_OPENREDIS_URL,
     ENV_REDISCLOUD_URL,
@@ -18,6 +20,14 @@ from dynoscale.constants import (
 logging.basicConfig(level=logging.DEBUG)
 
 
+@pytest.fixture
+def asgi_app_minimal():
+    async def app(scope, receive, send):
+        pass
+
+    return app
+
+
 # ========================= TESTS =============================
 
 def test_upload_payload_exits_and_logs_on_empty_payload(
@@ -184,16 +194,140 @@ def test_agent_attempts_to_start_rq_logger_when_any_of_the_supported_redis_urls_
         env_set_dyno_web1,
         env_set_dynoscale_url,
         monkeypatch,
+        tmp_path,
         p_environ,
         p_redis_url
 ):
     from dynoscale.agent import DynoscaleAgent
 
+    # the agent's thread opens the repository, keep it out of the working directory
+    monkeypatch.setenv(ENV_DYNOSCALE_DATA_DIR_NAME, str(tmp_path))
     monkeypatch.setenv(p_environ, p_redis_url)
     da = DynoscaleAgent()
     assert da.config.is_rq_available
 
 
+def test_agent_restarts_logger_thread_in_forked_process(env_valid):
+    from dynoscale.agent import DynoscaleAgent
+    da = DynoscaleAgent()
+    parent_thread, parent_buffer = da.t_logger, da.buffer
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            da.log_queue_time(123, 123)
+            restarted = da.t_logger is not parent_thread and da.t_logger.is_alive() and da.buffer is not parent_buffer
+            os._exit(0 if restarted else 1)
+        finally:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert da.t_logger is parent_thread
+    assert da.buffer is parent_buffer
+
+
+def test_forked_process_gets_locks_held_by_parent_threads(env_valid):
+    from dynoscale import agent
+    da = agent.DynoscaleAgent()
+
+    with da._start_lock, agent._agents_lock:  # as if other threads of the parent held them while forking
+        pid = os.fork()
+        if pid == 0:
+            try:
+                acquired = da._start_lock.acquire(timeout=1) and agent._agents_lock.acquire(timeout=1)
+                os._exit(0 if acquired else 1)
+            finally:
+                os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_get_agent_returns_one_agent_per_process_shared_by_all_integrations(env_valid, asgi_app_minimal):
+    from dynoscale.agent import get_agent, DynoscaleAgent, AsyncDynoscaleAgent
+    from dynoscale.asgi import DynoscaleAsgiApp
+    from dynoscale.hooks.gunicorn import GunicornHookProcessor
+    from dynoscale.wsgi import DynoscaleWsgiApp
+
+    agent = get_agent()
+    assert isinstance(agent, DynoscaleAgent)
+    assert DynoscaleWsgiApp(lambda environ, start_response: None).ds_agent is agent
+    assert DynoscaleWsgiApp(lambda environ, start_response: None).ds_agent is agent
+    assert DynoscaleAsgiApp(asgi_app_minimal).ds_agent is agent
+    assert GunicornHookProcessor().ds_agent is agent
+    assert isinstance(get_agent(use_asyncio=True), AsyncDynoscaleAgent)
+    assert get_agent(use_asyncio=True) is get_agent(use_asyncio=True)
+
+
+def test_rq_logger_shares_publisher_repository(env_valid, monkeypatch):
+    from dynoscale.agent import create_publisher
+    monkeypatch.setenv(ENV_REDIS_URL, "redis://localhost:3306")
+    publisher = create_publisher(enable_rq_logger=True)
+    assert publisher.pre_publish_hook.__self__.repository is publisher.repository
+
+
+def test_agent_shutdown_stores_and_publishes_remaining_records(
+        env_valid,
+        ds_repository,
+        mock_url,
+        mocked_api_200_no_config
+):
+    from dynoscale.agent import DynoscaleAgent
+    from dynoscale.utils import epoch_s
+    da = DynoscaleAgent()
+    da.log_queue_time(epoch_s(), 456)
+    da.shutdown(timeout=5)
+    assert not da.t_logger.is_alive()
+    assert [call.request.url for call in mocked_api_200_no_config.calls].count(mock_url) == 1
+    assert ds_repository.get_all_records() == ()
+
+
+def test_agent_shutdown_gives_up_after_timeout(env_valid, monkeypatch, caplog):
+    from dynoscale import agent
+    monkeypatch.setattr(agent, 'publish_remaining', lambda publisher: time.sleep(0.5))
+    da = agent.DynoscaleAgent()
+    with caplog.at_level(logging.WARNING):
+        da.shutdown(timeout=0.05)
+    assert "didn't finish within 0.05s" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_async_agent_shutdown_stores_and_publishes_remaining_records(
+        env_valid,
+        ds_repository,
+        mock_url,
+        mocked_api_200_no_config
+):
+    from dynoscale.agent import AsyncDynoscaleAgent
+    from dynoscale.utils import epoch_s
+    da = AsyncDynoscaleAgent()
+    da.log_queue_time(epoch_s(), 456)
+    await da.shutdown(timeout=5)
+    assert da.task.done()
+    assert [call.request.url for call in mocked_api_200_no_config.calls].count(mock_url) == 1
+    assert ds_repository.get_all_records() == ()
+
+
+def test_next_wakeup_follows_publish_schedule(ds_publisher):
+    from dynoscale.agent import next_wakeup, AGGREGATE_FLUSH_INTERVAL, MIN_WAKEUP_INTERVAL
+    ds_publisher.publish_frequency = 10
+    ds_publisher.last_publish_attempt = time.time()
+    assert 9 < next_wakeup(ds_publisher, aggregate=False) <= 10
+    assert next_wakeup(ds_publisher, aggregate=True) == AGGREGATE_FLUSH_INTERVAL
+    ds_publisher.last_publish_attempt = 0
+    assert next_wakeup(ds_publisher, aggregate=False) == MIN_WAKEUP_INTERVAL
+
+
+def test_agent_ticks_publisher_without_any_traffic(env_valid, ds_repository, caplog):
+    from dynoscale.agent import DynoscaleAgent
+    from dynoscale.publisher import KEY_PUBLISH_FREQUENCY
+    ds_repository[KEY_PUBLISH_FREQUENCY] = 0.2
+    with caplog.at_level(logging.INFO, logger="dynoscale.publisher"):
+        da = DynoscaleAgent()
+        time.sleep(1)
+        da.shutdown()
+    assert caplog.text.count("There is nothing to publish to Dynoscale.") >= 3
+
+
 @pytest.mark.asyncio
 @responses.activate
 async def test_async():
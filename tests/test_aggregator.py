@@ -0,0 +1,80 @@
+import logging
+import time
+
+import pytest
+
+from dynoscale.aggregator import QueueTimeAggregator, bucket_metadata, quantile
+from dynoscale.constants import ENV_DYNOSCALE_AGGREGATE
+from dynoscale.repository import Record
+from dynoscale.utils import epoch_s
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+# ========================= TESTS =============================
+
+@pytest.mark.parametrize(
+    "values, q, result",
+    [
+        ([5], 0.5, 5),
+        ([5], 0.99, 5),
+        ([1, 2, 3, 4], 0.5, 2),
+        ([1, 2, 3, 4], 0.9, 4),
+        (list(range(1, 101)), 0.5, 50),
+        (list(range(1, 101)), 0.9, 90),
+        (list(range(1, 101)), 0.99, 99),
+        (list(range(1, 101)), 0.0, 1),
+        (list(range(1, 101)), 1.0, 100),
+    ]
+)
+def test_quantile(values, q, result):
+    assert quantile(values, q) == result
+
+
+def test_bucket_metadata():
+    assert bucket_metadata([10, 20, 30]) == "count=3;sum=60;min=10;max=30;p50=20;p90=30;p99=30"
+
+
+def test_aggregator_folds_records_per_second_and_source():
+    aggregator = QueueTimeAggregator()
+    for metric in (30, 10, 20):
+        aggregator.add(Record(100, metric, "web", ""))
+    aggregator.add(Record(100, 5, "rq:default", ""))
+    aggregator.add(Record(101, 7, "web", ""))
+    assert len(aggregator) == 3
+
+    records = aggregator.flush()
+    assert len(aggregator) == 0
+    assert records == [
+        Record(100, 5, "rq:default", "count=1;sum=5;min=5;max=5;p50=5;p90=5;p99=5"),
+        Record(100, 30, "web", "count=3;sum=60;min=10;max=30;p50=20;p90=30;p99=30"),
+        Record(101, 7, "web", "count=1;sum=7;min=7;max=7;p50=7;p90=7;p99=7"),
+    ]
+
+
+def test_aggregator_flush_keeps_open_buckets():
+    aggregator = QueueTimeAggregator()
+    aggregator.add(Record(100, 1, "web", ""))
+    aggregator.add(Record(101, 2, "web", ""))
+    assert [r.timestamp for r in aggregator.flush(before=101)] == [100]
+    assert len(aggregator) == 1
+    assert aggregator.flush(before=101) == []
+    assert [r.timestamp for r in aggregator.flush(before=102)] == [101]
+
+
+def test_agent_stores_one_record_per_second_when_aggregating(env_valid, monkeypatch, ds_repository):
+    from dynoscale.agent import DynoscaleAgent
+    monkeypatch.setenv(ENV_DYNOSCALE_AGGREGATE, "1")
+    agent = DynoscaleAgent()
+    timestamp = epoch_s()
+    for queue_time in range(100):
+        agent.log_queue_time(timestamp, queue_time)
+
+    deadline = time.monotonic() + 5
+    while not ds_repository.get_all_records() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    records = ds_repository.get_all_records()
+    assert len(records) == 1
+    assert records[0].timestamp == timestamp
+    assert records[0].metric == 99
+    assert records[0].metadata.startswith("count=100;sum=4950;min=0;max=99")
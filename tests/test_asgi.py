@@ -12,6 +12,8 @@ from asgiref.typing import (
 )
 from starlette.responses import Response
 
+from dynoscale.constants import ENV_DYNOSCALE_ASYNCIO
+
 logging.basicConfig(level=logging.DEBUG)
 
 
@@ -169,7 +171,7 @@ def test_dynoscale_asgi_app_log_queue_time_doesnt_crash_with_invalid_settings(
         assert caplog.record_tuples
         assert len(caplog.record_tuples) == 1
         assert caplog.record_tuples == [
-            ('dynoscale.asgi.DynoscaleAsgiApp', 30, 'Can not calculate queue time from request headers: {}')]
+            ('dynoscale.asgi.DynoscaleAsgiApp', 20, 'Can not calculate queue time.')]
 
 
 @pytest.mark.asyncio
@@ -187,10 +189,36 @@ async def test_dynoscale_asgi_logs_queue_time(
         caplog.clear()
         await ds_app(asgi_scope_http, asgi_receive_callable, asgi_send_callable)
         await asyncio.sleep(0.1)
-        logged_add_record = [record for record in caplog.record_tuples if "add_record (" in record[2]]
+        logged_add_record = [record for record in caplog.record_tuples if "add_records (1 records)" in record[2]]
         assert len(logged_add_record) == 1
 
 
+@pytest.mark.asyncio
+async def test_dynoscale_asgi_logs_queue_time_with_asyncio_agent(
+        env_valid,
+        asgi_app,
+        asgi_scope_http,
+        asgi_receive_callable,
+        asgi_send_callable,
+        ds_repository,
+        monkeypatch
+):
+    from dynoscale.agent import AsyncDynoscaleAgent
+    from dynoscale.asgi import DynoscaleAsgiApp
+    monkeypatch.setenv(ENV_DYNOSCALE_ASYNCIO, "1")
+    ds_app = DynoscaleAsgiApp(asgi_app)
+    assert isinstance(ds_app.ds_agent, AsyncDynoscaleAgent)
+    for _ in range(3):
+        await ds_app(asgi_scope_http, asgi_receive_callable, asgi_send_callable)
+    assert ds_app.ds_agent.task.get_loop() is asyncio.get_running_loop()
+    for _ in range(50):
+        if len(ds_repository.get_all_records()) == 3:
+            break
+        await asyncio.sleep(0.02)
+    assert len(ds_repository.get_all_records()) == 3
+    ds_app.ds_agent.task.cancel()
+
+
 @pytest.mark.asyncio
 async def test_dynoscale_asgi_doesnt_log_queue_time_for_websocket_scope_type(
         env_valid,
@@ -235,3 +263,43 @@ async def test_dynoscale_asgi_doesnt_attempt_to_log_queue_time_for_lifespan_scop
         assert caplog.record_tuples[0][2] == "__call__"
         assert caplog.record_tuples[1][2] == "Scope type is not `http`."
         assert ds_repository.get_all_records() == ()
+
+
+@pytest.mark.asyncio
+async def test_dynoscale_asgi_shuts_down_agent_on_lifespan_shutdown(env_valid, asgi_send_callable, asgi_scope_lifespan):
+    from dynoscale.asgi import DynoscaleAsgiApp
+
+    async def lifespan_app(scope, receive, send):
+        assert (await receive())['type'] == 'lifespan.shutdown'
+
+    async def receive_shutdown():
+        return {'type': 'lifespan.shutdown'}
+
+    ds_app = DynoscaleAsgiApp(lifespan_app)
+    assert ds_app.ds_agent.t_logger.is_alive()
+    await ds_app(asgi_scope_lifespan, receive_shutdown, asgi_send_callable)
+    assert not ds_app.ds_agent.t_logger.is_alive()
+
+
+@pytest.mark.asyncio
+async def test_dynoscale_asgi_starts_asyncio_agent_on_lifespan_startup(
+        env_valid,
+        asgi_send_callable,
+        asgi_scope_lifespan,
+        monkeypatch
+):
+    from dynoscale.asgi import DynoscaleAsgiApp
+    monkeypatch.setenv(ENV_DYNOSCALE_ASYNCIO, "1")
+
+    async def lifespan_app(scope, receive, send):
+        assert (await receive())['type'] == 'lifespan.startup'
+
+    async def receive_startup():
+        return {'type': 'lifespan.startup'}
+
+    ds_app = DynoscaleAsgiApp(lifespan_app)
+    await ds_app(asgi_scope_lifespan, receive_startup, asgi_send_callable)
+    task = ds_app.ds_agent.task
+    assert task is not None and not task.done()
+    assert task.get_loop() is asyncio.get_running_loop()
+    task.cancel()
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from dynoscale.buffer import RingBuffer, OverflowPolicy
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+# ========================= TESTS =============================
+
+def test_ring_buffer_rejects_non_positive_capacity():
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+def test_ring_buffer_returns_items_in_order():
+    buffer = RingBuffer(3)
+    for i in range(3):
+        assert buffer.put(i)
+    assert len(buffer) == 3
+    assert [buffer.get(timeout=0) for _ in range(3)] == [0, 1, 2]
+    assert buffer.get(timeout=0) is None
+    assert buffer.dropped == 0
+
+
+def test_ring_buffer_drops_oldest_when_full():
+    buffer = RingBuffer(2, OverflowPolicy.DROP_OLDEST)
+    assert all(buffer.put(i) for i in range(5))
+    assert len(buffer) == 2
+    assert buffer.dropped == 3
+    assert [buffer.get(timeout=0), buffer.get(timeout=0)] == [3, 4]
+
+
+def test_ring_buffer_drops_newest_when_full():
+    buffer = RingBuffer(2, OverflowPolicy.DROP_NEWEST)
+    assert [buffer.put(i) for i in range(5)] == [True, True, False, False, False]
+    assert buffer.dropped == 3
+    assert [buffer.get(timeout=0), buffer.get(timeout=0)] == [0, 1]
+
+
+def test_ring_buffer_put_never_blocks_when_full():
+    buffer = RingBuffer(1)
+    start = time.monotonic()
+    for i in range(10_000):
+        buffer.put(i)
+    assert time.monotonic() - start < 1
+    assert len(buffer) == 1
+
+
+def test_ring_buffer_get_times_out():
+    buffer = RingBuffer(1)
+    start = time.monotonic()
+    assert buffer.get(timeout=0.05) is None
+    assert time.monotonic() - start >= 0.05
+
+
+def test_ring_buffer_get_wakes_up_on_put():
+    buffer = RingBuffer(10)
+    timer = threading.Timer(0.05, buffer.put, args=("record",))
+    timer.start()
+    assert buffer.get(timeout=5) == "record"
+    timer.join()
+
+
+def test_ring_buffer_drain_returns_up_to_max_items():
+    buffer = RingBuffer(10)
+    for i in range(5):
+        buffer.put(i)
+    assert buffer.drain(3, timeout=0) == [0, 1, 2]
+    assert buffer.drain(3, timeout=0) == [3, 4]
+    assert buffer.drain(3, timeout=0) == []
+
+
+def test_ring_buffer_close_wakes_up_waiting_consumer_and_keeps_items():
+    buffer = RingBuffer(10)
+    timer = threading.Timer(0.05, buffer.close)
+    timer.start()
+    start = time.monotonic()
+    assert buffer.get() is None
+    assert time.monotonic() - start < 5
+    timer.join()
+    buffer.put("late")
+    assert buffer.drain(10) == ["late"]
+    assert buffer.drain(10) == []
@@ -0,0 +1,238 @@
+import logging
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from dynoscale.collector import PipeCollector, PipeSampleSender, SAMPLE, SharedMemoryCollector, \
+    SharedMemorySampleSender
+from dynoscale.constants import ENV_DYNOSCALE_COLLECTOR
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class FakeAgent:
+    def __init__(self):
+        self.logged = []
+
+    def log_queue_time(self, timestamp: int, queue_time: int):
+        self.logged.append((timestamp, queue_time))
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def collector():
+    collector = PipeCollector(FakeAgent())
+    collector.start()
+    yield collector
+    collector.close()
+
+
+# ========================= TESTS =============================
+
+def test_sender_delivers_samples_to_collector(collector):
+    sender = collector.sender()
+    for i in range(1_000):
+        sender.log_queue_time(1_000 + i, i)
+    assert wait_for(lambda: len(collector.agent.logged) == 1_000)
+    assert collector.agent.logged == [(1_000 + i, i) for i in range(1_000)]
+    assert sender.dropped == 0
+
+
+def test_sender_delivers_samples_from_forked_process(collector):
+    pid = os.fork()
+    if pid == 0:
+        collector.sender().log_queue_time(1, 2)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert wait_for(lambda: collector.agent.logged == [(1, 2)])
+
+
+def test_sender_never_blocks_and_counts_dropped_samples_when_pipe_is_full():
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+    sender = PipeSampleSender(write_fd)
+    samples = 100_000  # way more than fits into a pipe
+    for i in range(samples):
+        sender.log_queue_time(i, i)
+    assert 0 < sender.dropped < samples
+    os.set_blocking(read_fd, False)
+    received = b''
+    try:
+        while True:
+            received += os.read(read_fd, 65536)
+    except BlockingIOError:
+        pass
+    assert len(received) == (samples - sender.dropped) * SAMPLE.size
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def test_sender_counts_dropped_samples_after_collector_closed():
+    collector = PipeCollector(FakeAgent())
+    collector.close()
+    sender = collector.sender()
+    sender.log_queue_time(1, 1)
+    assert sender.dropped == 1
+
+
+def test_gunicorn_hooks_use_collector_when_enabled(env_valid, monkeypatch):
+    from dynoscale.hooks import gunicorn
+    monkeypatch.setenv(ENV_DYNOSCALE_COLLECTOR, "pipe")
+
+    gunicorn.when_ready(server=None)
+    try:
+        collector = vars(gunicorn)[gunicorn.COLLECTOR_NAME]
+        collector.agent = FakeAgent()
+        processor = gunicorn.GunicornHookProcessor()
+        assert isinstance(processor.ds_agent, PipeSampleSender)
+        processor.pre_request(SimpleNamespace(pid=1), SimpleNamespace(headers=[("X-REQUEST-START", "1234123434")]))
+        assert wait_for(lambda: len(collector.agent.logged) == 1)
+    finally:
+        gunicorn.on_exit(server=None)
+    assert gunicorn.COLLECTOR_NAME not in vars(gunicorn)
+
+
+def test_gunicorn_when_ready_does_nothing_without_collector_mode(env_valid, monkeypatch):
+    from dynoscale.hooks import gunicorn
+    monkeypatch.delenv(ENV_DYNOSCALE_COLLECTOR, raising=False)
+    gunicorn.when_ready(server=None)
+    assert gunicorn.COLLECTOR_NAME not in vars(gunicorn)
+    gunicorn.on_exit(server=None)
+
+
+@pytest.fixture
+def shm_collector():
+    collector = SharedMemoryCollector(FakeAgent(), lanes=4, lane_capacity=16)
+    yield collector
+    collector.close()
+
+
+def test_shm_sender_delivers_samples_to_collector(shm_collector):
+    sender = shm_collector.sender(shm_collector.acquire_lane())
+    for i in range(10):
+        sender.log_queue_time(1_000 + i, i)
+    assert shm_collector.drain() == 10
+    assert shm_collector.agent.logged == [(1_000 + i, i) for i in range(10)]
+    assert shm_collector.drain() == 0
+
+
+def test_shm_sender_wraps_around_lane_and_drops_when_full(shm_collector):
+    sender = shm_collector.sender(shm_collector.acquire_lane())
+    for i in range(10):
+        sender.log_queue_time(i, i)
+    shm_collector.drain()
+    for i in range(20):
+        sender.log_queue_time(100 + i, i)
+    assert sender.dropped == 4
+    assert shm_collector.drain() == 16
+    assert shm_collector.agent.logged[10:] == [(100 + i, i) for i in range(16)]
+
+
+def test_shm_sender_delivers_samples_from_forked_processes(shm_collector):
+    shm_collector.start()
+    pids = []
+    for worker in range(3):
+        lane = shm_collector.acquire_lane()
+        pid = os.fork()
+        if pid == 0:
+            sender = shm_collector.sender(lane)
+            for i in range(5):
+                sender.log_queue_time(worker, i)
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    assert wait_for(lambda: len(shm_collector.agent.logged) == 15)
+    assert sorted(shm_collector.agent.logged) == [(w, i) for w in range(3) for i in range(5)]
+
+
+def test_shm_collector_hands_out_every_lane_once(shm_collector):
+    lanes = [shm_collector.acquire_lane() for _ in range(4)]
+    assert lanes == [0, 1, 2, 3]
+    assert shm_collector.acquire_lane() is None
+    shm_collector.release_lane(2)
+    assert shm_collector.acquire_lane() == 2
+
+
+def test_shm_reused_lane_continues_after_samples_of_previous_worker(shm_collector):
+    lane = shm_collector.acquire_lane()
+    shm_collector.sender(lane).log_queue_time(1, 1)
+    shm_collector.release_lane(lane)
+    assert shm_collector.acquire_lane() == lane
+    shm_collector.sender(lane).log_queue_time(2, 2)
+    shm_collector.drain()
+    assert shm_collector.agent.logged == [(1, 1), (2, 2)]
+
+
+def test_shm_sender_counts_dropped_samples_after_collector_closed():
+    collector = SharedMemoryCollector(FakeAgent(), lanes=1, lane_capacity=1)
+    sender = collector.sender(collector.acquire_lane())
+    collector.close()
+    sender.log_queue_time(1, 1)
+    assert sender.dropped == 1
+
+
+def test_gunicorn_hooks_use_shm_collector_lane_of_worker(env_valid, monkeypatch):
+    from dynoscale.hooks import gunicorn
+    monkeypatch.setenv(ENV_DYNOSCALE_COLLECTOR, "shm")
+
+    gunicorn.when_ready(server=None)
+    try:
+        collector = vars(gunicorn)[gunicorn.COLLECTOR_NAME]
+        collector.agent = FakeAgent()
+        worker = SimpleNamespace(pid=1)
+        gunicorn.pre_fork(server=None, worker=worker)
+        assert getattr(worker, gunicorn.LANE_ATTRIBUTE) == 0
+        processor = gunicorn.GunicornHookProcessor(worker)
+        assert isinstance(processor.ds_agent, SharedMemorySampleSender)
+        processor.pre_request(worker, SimpleNamespace(headers=[("X-REQUEST-START", "1234123434")]))
+        assert wait_for(lambda: len(collector.agent.logged) == 1)
+        gunicorn.child_exit(server=None, worker=worker)
+        assert collector.acquire_lane() == 0
+    finally:
+        gunicorn.on_exit(server=None)
+
+
+def test_wsgi_app_uses_collector_inherited_from_master(env_valid, monkeypatch):
+    from dynoscale.hooks import gunicorn
+    from dynoscale.wsgi import DynoscaleWsgiApp
+    monkeypatch.setenv(ENV_DYNOSCALE_COLLECTOR, "pipe")
+
+    gunicorn.when_ready(server=None)
+    try:
+        collector = vars(gunicorn)[gunicorn.COLLECTOR_NAME]
+        collector.agent = FakeAgent()
+        app = DynoscaleWsgiApp(lambda environ, start_response: None)
+        assert isinstance(app.ds_agent, PipeSampleSender)
+        app({"HTTP_X_REQUEST_START": "1234123434"}, None)
+        assert wait_for(lambda: len(collector.agent.logged) == 1)
+    finally:
+        gunicorn.on_exit(server=None)
+
+
+def test_wsgi_app_and_hook_share_the_shm_lane_of_the_forked_worker(env_valid, monkeypatch):
+    from dynoscale.hooks import gunicorn
+    from dynoscale.wsgi import DynoscaleWsgiApp
+    monkeypatch.setenv(ENV_DYNOSCALE_COLLECTOR, "shm")
+
+    gunicorn.when_ready(server=None)
+    try:
+        collector = vars(gunicorn)[gunicorn.COLLECTOR_NAME]
+        collector.agent = FakeAgent()
+        worker = SimpleNamespace(pid=1)
+        gunicorn.pre_fork(server=None, worker=worker)
+        app = DynoscaleWsgiApp(lambda environ, start_response: None)
+        assert isinstance(app.ds_agent, SharedMemorySampleSender)
+        assert gunicorn.GunicornHookProcessor(worker).ds_agent is app.ds_agent
+        app({"HTTP_X_REQUEST_START": "1234123434"}, None)
+        assert wait_for(lambda: len(collector.agent.logged) == 1)
+    finally:
+        gunicorn.on_exit(server=None)
@@ -3,7 +3,10 @@ from contextlib import nullcontext as does_not_raise
 
 import pytest
 
+from dynoscale.buffer import DEFAULT_BUFFER_CAPACITY, OverflowPolicy
 from dynoscale.config import Config
+from dynoscale.constants import ENV_DYNOSCALE_BUFFER_CAPACITY, ENV_DYNOSCALE_BUFFER_POLICY, ENV_DYNOSCALE_REPOSITORY
+from dynoscale.repository import RepositoryBackend
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -34,6 +37,29 @@ def test_config_with_invalid_env_vars_and_dev_mode_is_invalid(env_invalid_missin
     assert not c.is_valid
 
 
+@pytest.mark.parametrize(
+    "capacity,policy,expected_capacity,expected_policy",
+    [
+        (None, None, DEFAULT_BUFFER_CAPACITY, OverflowPolicy.DROP_OLDEST),
+        ("100", "drop_newest", 100, OverflowPolicy.DROP_NEWEST),
+        ("100", "DROP_NEWEST", 100, OverflowPolicy.DROP_NEWEST),
+        ("100", "drop_oldest", 100, OverflowPolicy.DROP_OLDEST),
+        ("0", "unknown", DEFAULT_BUFFER_CAPACITY, OverflowPolicy.DROP_OLDEST),
+        ("-5", "", DEFAULT_BUFFER_CAPACITY, OverflowPolicy.DROP_OLDEST),
+        ("lots", None, DEFAULT_BUFFER_CAPACITY, OverflowPolicy.DROP_OLDEST),
+    ]
+)
+def test_config_buffer_settings_from_environ(monkeypatch, capacity, policy, expected_capacity, expected_policy):
+    for name, value in ((ENV_DYNOSCALE_BUFFER_CAPACITY, capacity), (ENV_DYNOSCALE_BUFFER_POLICY, policy)):
+        if value is None:
+            monkeypatch.delenv(name, raising=False)
+        else:
+            monkeypatch.setenv(name, value)
+    config = Config()
+    assert config.buffer_capacity == expected_capacity
+    assert config.buffer_overflow_policy == expected_policy
+
+
 # noinspection HttpUrlsUsage
 @pytest.mark.parametrize(
     "dyno,url,is_valid, expectation",
@@ -89,3 +115,22 @@ def test_config_with_env_vars(env_invalid_missing_dyno, monkeypatch, dyno, url,
     with expectation:
         config = Config()
         assert config.is_valid == is_valid
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (None, RepositoryBackend.SQLITE),
+        ("sqlite", RepositoryBackend.SQLITE),
+        ("memory", RepositoryBackend.MEMORY),
+        (" Memory ", RepositoryBackend.MEMORY),
+        ("mmap", RepositoryBackend.MMAP),
+        ("unknown", RepositoryBackend.SQLITE),
+    ]
+)
+def test_config_repository_backend_from_environ(monkeypatch, value, expected):
+    if value is None:
+        monkeypatch.delenv(ENV_DYNOSCALE_REPOSITORY, raising=False)
+    else:
+        monkeypatch.setenv(ENV_DYNOSCALE_REPOSITORY, value)
+    assert Config().repository_backend is expected
@@ -41,3 +41,13 @@ def test_gunicorn_pre_request_doesnt_crash_with_invalid_settings(env_valid, work
     from dynoscale.hooks.gunicorn import GunicornHookProcessor
     g = GunicornHookProcessor()
     g.pre_request(worker, req)
+
+
+def test_gunicorn_worker_exit_shuts_down_agent(env_valid, worker, req, monkeypatch):
+    from dynoscale.hooks import gunicorn
+    monkeypatch.delitem(vars(gunicorn), gunicorn.PROC_NAME, raising=False)
+    gunicorn.pre_request(worker, req)
+    agent = vars(gunicorn)[gunicorn.PROC_NAME].ds_agent
+    assert agent.t_logger.is_alive()
+    gunicorn.worker_exit(server=None, worker=worker)
+    assert not agent.t_logger.is_alive()
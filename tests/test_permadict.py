@@ -5,7 +5,7 @@ from tempfile import gettempdir
 
 import pytest
 
-from dynoscale.permadict import Permadict
+from dynoscale.permadict import Permadict, PickleCodec, PrimitiveCodec
 
 
 @pytest.fixture
@@ -178,3 +178,125 @@ def test_context(db_filename):
 
     with Permadict(db_filename) as d:
         assert d["key"] == "value"
+
+
+def count_statements(d):
+    statements = []
+    d.conn.set_trace_callback(statements.append)
+    return statements
+
+
+def test_cache_serves_reads_without_queries(db_filename):
+    d = Permadict(db_filename, cache_size=2)
+    d["a"] = 1
+    statements = count_statements(d)
+    assert d["a"] == 1
+    assert "a" in d
+    assert d.get("a") == 1
+    assert statements == []
+    with Permadict(db_filename) as other:
+        assert other["a"] == 1  # written through
+
+
+def test_cache_evicts_least_recently_used(db_filename):
+    d = Permadict(db_filename, cache_size=2)
+    d["a"], d["b"] = 1, 2
+    # noinspection PyStatementEffect
+    d["a"]
+    d["c"] = 3
+    assert list(d._cache) == ["a", "c"]
+    assert d["b"] == 2
+    assert len(d._cache) == 2
+
+
+def test_cache_forgets_deleted_keys():
+    d = Permadict(cache_size=4, a=1, b=2, c=3)
+    del d["a"]
+    assert "a" not in d
+    assert d.pop("b") == 2
+    assert "b" not in d
+    assert d.pop("b", None) is None
+    d.clear()
+    assert "c" not in d
+
+
+def test_membership_doesnt_load_values():
+    d = Permadict(key="value")
+    statements = count_statements(d)
+    assert "key" in d
+    assert "nope" not in d
+    assert all("EXISTS" in statement for statement in statements if statement.startswith("SELECT"))
+
+
+def test_items_and_values_use_a_single_query():
+    d = Permadict(a=1, b=2, c=3)
+    statements = count_statements(d)
+    assert dict(d.items()) == dict(a=1, b=2, c=3)
+    assert sorted(d.values()) == [1, 2, 3]
+    assert len([statement for statement in statements if statement.startswith("SELECT")]) == 2
+
+
+@pytest.mark.parametrize(
+    "value", [None, 0, -1, 2 ** 80, 1.5, float("inf"), "", "žluťoučký", b"", b"\x80\x00", True, [1, "a"], {"a": 1}]
+)
+def test_primitive_codec_round_trips(value):
+    codec = PrimitiveCodec()
+    decoded = codec.decode(codec.encode(value))
+    assert decoded == value
+    assert type(decoded) is type(value)
+
+
+def test_primitive_codec_skips_pickle_for_primitives():
+    codec = PrimitiveCodec()
+    assert [codec.encode(v)[:1] for v in (None, 1, 1.0, "s", b"b")] == [b"N", b"i", b"f", b"s", b"b"]
+    assert codec.encode([1])[:1] == b"\x80"
+
+
+def test_primitive_codec_reads_values_pickled_before(db_filename):
+    with Permadict(db_filename, codec=PickleCodec(), a=1.5, b="text", c=[1]) as d:
+        assert d["a"] == 1.5
+    with Permadict(db_filename) as d:
+        assert dict(d.items()) == {"a": 1.5, "b": "text", "c": [1]}
+
+
+def test_update_writes_in_a_single_transaction():
+    d = Permadict()
+    statements = count_statements(d)
+    d.update({"a": 1}, b=2)
+    d.update([("c", 3), ("d", 4)])
+    assert len([statement for statement in statements if statement.startswith("BEGIN")]) == 2
+    assert dict(d.items()) == dict(a=1, b=2, c=3, d=4)
+
+
+def test_primitive_codec_without_pickle_refuses_other_values():
+    codec = PrimitiveCodec(allow_pickle=False)
+    assert codec.decode(codec.encode(1.5)) == 1.5
+    with pytest.raises(TypeError):
+        codec.encode([1])
+    with pytest.raises(ValueError):
+        codec.decode(PickleCodec().encode(1.5))
+
+
+def test_primitive_codec_reports_truncated_values_as_value_error():
+    with pytest.raises(ValueError):
+        PrimitiveCodec().decode(b'f')
+    with pytest.raises(ValueError):
+        PrimitiveCodec(allow_pickle=False).decode(PrimitiveCodec.FLOAT + b'\x00\x01')
+
+
+def test_pop_reads_and_deletes_in_one_transaction():
+    d = Permadict(a=1)
+    statements = count_statements(d)
+    assert d.pop("a") == 1
+    assert statements[0] == "BEGIN IMMEDIATE"
+    assert statements[-1] == "COMMIT"
+    assert "BEGIN" not in " ".join(statements[1:])
+
+
+def test_missing_keys_raise_key_error_for_any_key_type():
+    d = Permadict()
+    with pytest.raises(KeyError):
+        # noinspection PyStatementEffect
+        d[1]
+    with pytest.raises(KeyError):
+        d.pop(b"key")
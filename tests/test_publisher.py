@@ -199,6 +199,208 @@ def test_publisher_doesnt_crash_when_prepublish_hook_raises_exception(
         ]
 
 
+def test_publisher_state_is_written_through_to_repository(ds_publisher):
+    from dynoscale.publisher import DynoscalePublisher, KEY_PUBLISH_FREQUENCY, KEY_LAST_PUBLISH_ATTEMPT
+    ds_publisher.publish_frequency = 12.5
+    ds_publisher.last_publish_attempt = 1234.5
+    assert ds_publisher.repository[KEY_PUBLISH_FREQUENCY] == 12.5
+    assert ds_publisher.repository[KEY_LAST_PUBLISH_ATTEMPT] == 1234.5
+
+    restarted = DynoscalePublisher()
+    assert restarted.publish_frequency == 12.5
+    assert restarted.last_publish_attempt == 1234.5
+
+
+def test_publisher_should_publish_reads_repository_only_once_due(ds_publisher, monkeypatch):
+    ds_publisher.last_publish_attempt = time.time()
+
+    def do_raise(*args, **kwargs):
+        raise AssertionError("should_publish touched the repository")
+
+    with monkeypatch.context() as m:
+        m.setattr(ds_publisher.repository, "get", do_raise)
+        assert not ds_publisher.should_publish()
+    ds_publisher.last_publish_attempt = time.time() - 2 * ds_publisher.publish_frequency
+    assert ds_publisher.should_publish()
+
+
+def test_publishers_sharing_repository_publish_once_per_window(ds_publisher):
+    from dynoscale.publisher import DynoscalePublisher
+    other = DynoscalePublisher()  # another worker, same repository file
+    assert ds_publisher.should_publish() and other.should_publish()
+    ds_publisher.last_publish_attempt = time.time()
+    assert not ds_publisher.should_publish()
+    assert not other.should_publish()
+    assert other.seconds_until_publish() > 0
+    assert other.last_publish_attempt == ds_publisher.last_publish_attempt
+
+
+def test_publisher_seconds_until_publish(ds_publisher):
+    ds_publisher.publish_frequency = 10
+    ds_publisher.last_publish_attempt = time.time()
+    assert 9 < ds_publisher.seconds_until_publish() <= 10
+    ds_publisher.last_publish_attempt = time.time() - 20
+    assert ds_publisher.seconds_until_publish() == 0
+
+
+def test_upload_payload_uses_connect_and_read_timeouts(mock_url, mocked_responses):
+    from dynoscale.publisher import upload_payload, UPLOAD_TIMEOUT
+    mocked_responses.add(responses.POST, mock_url, status=200)
+    upload_payload(mock_url, b"payload", "web.1")
+    assert mocked_responses.calls[0].request.req_kwargs['timeout'] == UPLOAD_TIMEOUT
+
+
+@pytest.mark.parametrize(
+    "statuses, expected_calls", [
+        ([200], 1),
+        ([400], 1),
+        ([503, 200], 2),
+        ([429, 500, 200], 3),
+        ([500, 500, 500, 200], 3),
+    ]
+)
+def test_upload_with_retries_retries_only_retryable_failures(mock_url, mocked_responses, statuses, expected_calls):
+    from dynoscale.publisher import upload_with_retries
+    mocked_responses.assert_all_requests_are_fired = False
+    for status in statuses:
+        mocked_responses.add(responses.POST, mock_url, status=status)
+    delays = []
+    response = upload_with_retries(mock_url, b"payload", "web.1", sleep=delays.append)
+    assert len(mocked_responses.calls) == expected_calls
+    assert response.status_code == statuses[expected_calls - 1]
+    assert len(delays) == expected_calls - 1
+
+
+def test_retry_delay_is_jittered_and_bounded():
+    from dynoscale.publisher import retry_delay, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX
+    for retry in range(10):
+        for _ in range(20):
+            assert 0 <= retry_delay(retry) <= min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** retry)
+
+
+def test_circuit_breaker_opens_after_failures_and_probes_after_timeout():
+    from dynoscale.publisher import CircuitBreaker
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    now[0] = 10
+    assert breaker.allow()  # the probe
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    now[0] = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_publisher_skips_upload_while_circuit_is_open(ds_publisher, mocked_responses, mock_url):
+    from dynoscale.publisher import CircuitBreaker
+    mocked_responses.add(responses.POST, mock_url, status=400)
+    ds_publisher.circuit_breaker = CircuitBreaker(failure_threshold=1)
+    ds_publisher.repository.add_record(Record(epoch_s(), 0, 'web', ''))
+    ds_publisher.publish()
+    ds_publisher.publish()
+    assert len(mocked_responses.calls) == 1
+    assert ds_publisher.circuit_breaker.state == CircuitBreaker.OPEN
+    assert len(ds_publisher.repository.get_all_records()) == 1
+
+
+def test_compact_csv_from_records_delta_encodes_timestamps_and_dictionary_encodes_sources():
+    from dynoscale.publisher import compact_csv_from_records
+    from dynoscale.repository import RecordOut
+    records = [
+        RecordOut(1660000000, 12, 'web', '', row_id=1),
+        RecordOut(1660000000, 15, 'web', '', row_id=2),
+        RecordOut(1660000001, 3000, 'rq:default', 'a,b', row_id=3),
+    ]
+    assert compact_csv_from_records(records).decode() == (
+        'web,rq:default\r\n'
+        '1660000000,12,0,\r\n'
+        '0,15,0,\r\n'
+        '1,3000,1,"a,b"\r\n'
+    )
+
+
+def test_encode_payload_gzip_round_trip():
+    import gzip
+    from dynoscale.publisher import encode_payload, csv_from_records
+    from dynoscale.repository import RecordOut
+    records = [RecordOut(1660000000 + i, i, 'web', '', row_id=i) for i in range(1_000)]
+    payload, headers = encode_payload(records, content_encoding='gzip')
+    assert headers == {'Content-Type': 'text/csv', 'Content-Encoding': 'gzip'}
+    assert gzip.decompress(payload) == csv_from_records(records)
+    compact, compact_headers = encode_payload(records, payload_format='compact', content_encoding='gzip')
+    assert compact_headers['Content-Type'] == 'text/csv; format=compact'
+    assert len(compact) < len(payload)
+
+
+def test_extract_config_response_negotiates_encodings(mock_url, mocked_responses):
+    from dynoscale.publisher import extract_config_response
+    config = {"publish_frequency": 30, "content_encoding": "gzip", "payload_format": "compact"}
+    mocked_responses.add(responses.POST, mock_url, json={"config": config})
+    mocked_responses.add(responses.POST, mock_url, json={"config": {"publish_frequency": 30, "content_encoding": "br"}})
+    first = extract_config_response(requests.post(mock_url))
+    assert (first.content_encoding, first.payload_format) == ("gzip", "compact")
+    unsupported = extract_config_response(requests.post(mock_url))
+    assert (unsupported.content_encoding, unsupported.payload_format) == (None, "csv")
+
+
+def test_publisher_uses_negotiated_encodings_from_next_publish(ds_publisher, mocked_responses, mock_url):
+    import gzip
+    from dynoscale.publisher import DynoscalePublisher
+    config = {"publish_frequency": 30, "content_encoding": "gzip", "payload_format": "compact"}
+    mocked_responses.add(responses.POST, mock_url, json={"config": config})
+    mocked_responses.add(responses.POST, mock_url, json={"config": config})
+    timestamp = epoch_s()
+    ds_publisher.repository.add_record(Record(timestamp, 0, 'web', ''))
+    ds_publisher.publish()
+    assert 'Content-Encoding' not in mocked_responses.calls[0].request.headers
+    assert DynoscalePublisher().content_encoding == 'gzip'
+
+    ds_publisher.repository.add_record(Record(timestamp, 7, 'web', ''))
+    ds_publisher.publish()
+    request = mocked_responses.calls[1].request
+    assert request.headers['Content-Encoding'] == 'gzip'
+    assert request.headers['Content-Type'] == 'text/csv; format=compact'
+    assert gzip.decompress(request.body).decode() == f'web\r\n{timestamp},7,0,\r\n'
+
+
+def test_publisher_uploads_and_deletes_backlog_in_batches(ds_publisher, mocked_responses, mock_url, monkeypatch):
+    from dynoscale import publisher
+    monkeypatch.setattr(publisher, 'PUBLISH_BATCH_SIZE', 4)
+    mocked_responses.add(responses.POST, mock_url, status=200)
+    mocked_responses.add(responses.POST, mock_url, status=200)
+    mocked_responses.add(responses.POST, mock_url, status=400)
+    timestamp = epoch_s()
+    ds_publisher.repository.add_records(Record(timestamp, i, 'web', '') for i in range(10))
+    ds_publisher.publish()
+    assert [len(call.request.body.splitlines()) for call in mocked_responses.calls] == [4, 4, 2]
+    # the failed last batch stays for the next publish
+    assert [r.metric for r in ds_publisher.repository.get_all_records()] == [8, 9]
+    assert ds_publisher.last_publish_success
+
+
+def test_publisher_publishes_from_in_memory_repository(env_valid, monkeypatch, mocked_api_200_no_config):
+    from dynoscale.constants import ENV_DYNOSCALE_REPOSITORY
+    from dynoscale.publisher import DynoscalePublisher
+    from dynoscale.repository import InMemoryRepository
+    monkeypatch.setenv(ENV_DYNOSCALE_REPOSITORY, "memory")
+    publisher = DynoscalePublisher()
+    assert isinstance(publisher.repository, InMemoryRepository)
+    publisher.repository.add_record(Record(epoch_s(), 0, 'web', ''))
+    publisher.publish()
+    assert len(mocked_api_200_no_config.calls) == 1
+    assert publisher.repository.get_all_records() == ()
+    assert publisher.last_publish_success
+
+
 @pytest.mark.asyncio
 @responses.activate
 async def test_async():
@@ -208,3 +410,12 @@ async def test_async():
     after = time.time()
     assert before < after
     assert before + sleep_time < after
+
+
+def test_payload_of_record_batch_equals_payload_of_records():
+    from dynoscale.publisher import csv_from_records, compact_csv_from_records
+    from dynoscale.repository import RecordBatch, RecordOut
+    records = [RecordOut(1660000000 + i // 3, i, ('web', 'rq:default')[i % 2], '', row_id=i) for i in range(10)]
+    batch = RecordBatch.from_records(records)
+    assert csv_from_records(batch) == csv_from_records(records)
+    assert compact_csv_from_records(batch) == compact_csv_from_records(tuple(records))
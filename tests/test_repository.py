@@ -1,13 +1,40 @@
+import fcntl
 import logging
+import sqlite3
 from contextlib import nullcontext as does_not_raise
 
 import pytest
 
-from dynoscale.repository import DynoscaleRepository, Record, RecordOut, RecordIn
+from dynoscale.repository import (
+    DynoscaleRepository,
+    RepositoryBackend,
+    create_repository,
+    InMemoryRepository,
+    MmapRepository,
+    RecordBatch,
+    Record,
+    RecordOut,
+    RecordIn,
+    AUTO_VACUUM_INCREMENTAL,
+    RECLAIM_FREE_PAGES_THRESHOLD,
+    RECLAIM_MAX_PAGES,
+    MMAP_HEADER,
+    MMAP_HEADER_SIZE,
+    MMAP_RECORD_SIZE,
+    MMAP_METADATA_SIZE,
+    PARTITION_ROW_BITS,
+    PARTITION_SECONDS,
+    row_id_ranges,
+)
 
 logging.basicConfig(level=logging.DEBUG)
 
 
+@pytest.fixture(params=list(RepositoryBackend), ids=lambda backend: backend.value)
+def backend(request) -> RepositoryBackend:
+    yield request.param
+
+
 # ========================= TESTS =============================
 
 @pytest.mark.parametrize(
@@ -34,15 +61,15 @@ logging.basicConfig(level=logging.DEBUG)
         # ([], pytest.raises(ZeroDivisionError)),
     ],
 )
-def test_repo_checks_input(ds_repository, records, expectation):
+def test_repo_checks_input(repo_path, backend, records, expectation):
     with expectation:
-        ds_repository.delete_records(records=records)
+        create_repository(repo_path, backend).delete_records(records=records)
 
 
-def test_repo_adding_records(repo_path):
+def test_repo_adding_records(repo_path, backend):
     rng = 10
-    a = DynoscaleRepository(path=repo_path)
-    b = DynoscaleRepository(path=repo_path)
+    a = create_repository(repo_path, backend)
+    b = create_repository(repo_path, backend)
     records = [Record(1, 1, "", "") for i in range(rng)]
     for i, r in enumerate(records):
         (a if i % 2 else b).add_record(r)
@@ -53,12 +80,300 @@ def test_repo_adding_records(repo_path):
     assert ra == rb
 
 
-def test_repo_deleting_records(repo_path):
+def test_repo_deleting_records(repo_path, backend):
     rng = 5
-    a = DynoscaleRepository(path=repo_path)
-    b = DynoscaleRepository(path=repo_path)
+    a = create_repository(repo_path, backend)
+    b = create_repository(repo_path, backend)
     records = [Record(1, 1, "", "") for i in range(rng)]
     map(a.add_record, records)
     b.delete_records(a.get_all_records())
     assert len(a.get_all_records()) == 0
     assert len(b.get_all_records()) == 0
+
+
+def test_repo_adding_records_in_bulk(repo_path, backend):
+    repo = create_repository(repo_path, backend)
+    repo.add_records([])
+    assert repo.get_all_records() == ()
+    repo.add_records(Record(i, i * 10, "web", "") for i in range(100))
+    records = repo.get_all_records()
+    assert len(records) == 100
+    assert [(r.timestamp, r.metric) for r in records] == [(i, i * 10) for i in range(100)]
+
+
+def test_repo_enables_incremental_vacuum_on_existing_database(repo_path):
+    conn = sqlite3.connect(repo_path)
+    conn.execute('CREATE TABLE logs(timestamp INTEGER, metric INTEGER, source STRING, metadata STRING)')
+    conn.execute('INSERT INTO logs VALUES (1, 1, "web", "")')
+    conn.commit()
+    conn.close()
+
+    repo = DynoscaleRepository(path=repo_path)
+    assert repo.conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+    assert len(repo.get_all_records()) == 1
+
+
+def test_repo_never_unpickles_state(repo_path):
+    from dynoscale.permadict import Permadict, PickleCodec
+    with Permadict(str(repo_path), codec=PickleCodec(), publish_frequency=12.5, payload_format="csv") as legacy:
+        legacy["other"] = 1
+
+    repo = DynoscaleRepository(path=repo_path)
+    assert dict(repo.items()) == {}
+    repo["publish_frequency"] = 12.5
+    with pytest.raises(TypeError):
+        repo["unsafe"] = [1]
+    assert dict(DynoscaleRepository(path=repo_path).items()) == {"publish_frequency": 12.5}
+
+
+def test_repo_drops_truncated_state(repo_path):
+    conn = sqlite3.connect(repo_path)
+    conn.execute('CREATE TABLE dict (name BLOB PRIMARY KEY, object BLOB)')
+    conn.execute("INSERT INTO dict VALUES ('publish_frequency', ?)", (b'f',))
+    conn.commit()
+    conn.close()
+
+    repo = DynoscaleRepository(path=repo_path)
+    assert dict(repo.items()) == {}
+
+
+def test_repo_reclaims_free_pages_in_bounded_steps(repo_path):
+    def free_pages():
+        return repo.conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+    repo = DynoscaleRepository(path=repo_path)
+    repo.add_records(Record(i, i, "web", "x" * 500) for i in range(20_000))
+    repo.delete_records_before(1)
+    assert free_pages() < RECLAIM_FREE_PAGES_THRESHOLD
+
+    repo.delete_records_before(20_000)
+    assert free_pages() > RECLAIM_MAX_PAGES, "not enough free pages to show that reclaiming is bounded"
+    freed_before = free_pages()
+    repo.delete_records_before(20_000)
+    assert free_pages() == freed_before - RECLAIM_MAX_PAGES
+
+
+@pytest.mark.parametrize(
+    "row_ids, ranges",
+    [
+        ([], []),
+        ([1], [(1, 1)]),
+        ([1, 2, 3], [(1, 3)]),
+        ([3, 1, 2, 2], [(1, 3)]),
+        ([1, 2, 4, 5, 7], [(1, 2), (4, 5), (7, 7)]),
+    ]
+)
+def test_row_id_ranges(row_ids, ranges):
+    assert row_id_ranges(row_ids) == ranges
+
+
+def test_repo_has_timestamp_index(repo_path):
+    repo = DynoscaleRepository(path=repo_path)
+    repo.add_record(Record(PARTITION_SECONDS, 1, "web", ""))
+    plan = repo.conn.execute('EXPLAIN QUERY PLAN DELETE FROM "logs_1" WHERE timestamp < 10').fetchall()
+    assert any('ix_logs_1_timestamp' in row[-1] for row in plan)
+
+
+def partition_tables(repo):
+    return repo.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'logs*'").fetchall()
+
+
+def test_repo_stores_records_in_partitions_by_timestamp(repo_path):
+    repo = DynoscaleRepository(path=repo_path)
+    repo.add_records(Record(i * 30, i, "web", "") for i in range(5))
+    assert sorted(partition_tables(repo)) == [('logs_0',), ('logs_1',), ('logs_2',)]
+    assert [r.row_id >> PARTITION_ROW_BITS for r in repo.get_all_records()] == [0, 0, 1, 1, 2]
+
+
+def test_repo_drops_expired_partitions_as_a_whole(repo_path):
+    repo = DynoscaleRepository(path=repo_path)
+    repo.add_records(Record(i, i, "web", "") for i in range(3 * PARTITION_SECONDS))
+    statements = []
+    repo.conn.set_trace_callback(statements.append)
+    repo.delete_records_before(PARTITION_SECONDS + 10)
+    assert [s for s in statements if s.startswith(('DROP', 'DELETE'))] == [
+        'DROP TABLE IF EXISTS "logs_0"', 'DELETE FROM "logs_1" WHERE timestamp < (70)'
+    ]
+    assert [r.timestamp for r in repo.get_all_records()] == list(range(PARTITION_SECONDS + 10, 3 * PARTITION_SECONDS))
+
+
+def test_repo_drops_partitions_deleted_as_a_whole(repo_path):
+    repo = DynoscaleRepository(path=repo_path)
+    repo.add_records(Record(i, i, "web", "") for i in range(2 * PARTITION_SECONDS))
+    first_partition = repo.get_all_records()[:PARTITION_SECONDS + 1]
+    repo.delete_records(first_partition)
+    assert partition_tables(repo) == [('logs_1',)]
+    assert len(repo.get_all_records()) == PARTITION_SECONDS - 1
+    repo.add_record(Record(0, 0, "web", ""))
+    assert [r.timestamp for r in repo.get_all_records()][:2] == [0, PARTITION_SECONDS + 1]
+
+
+def test_repo_moves_records_of_unpartitioned_log_table_into_partitions(repo_path):
+    conn = sqlite3.connect(repo_path)
+    conn.execute('CREATE TABLE logs(timestamp INTEGER, metric INTEGER, source STRING, metadata STRING)')
+    conn.executemany('INSERT INTO logs VALUES (?, ?, "web", "")', [(ts, ts) for ts in (90, 10, 20)])
+    conn.commit()
+    conn.close()
+
+    repo = DynoscaleRepository(path=repo_path)
+    assert sorted(partition_tables(repo)) == [('logs_0',), ('logs_1',)]
+    assert [r.metric for r in repo.get_all_records()] == [10, 20, 90]
+
+
+def test_repo_deletes_only_given_records(repo_path, backend):
+    repo = create_repository(repo_path, backend)
+    repo.add_records(Record(i, i, "web", "") for i in range(10))
+    records = repo.get_all_records()
+    repo.delete_records(tuple(r for r in records if r.metric not in (3, 7)))
+    assert [r.metric for r in repo.get_all_records()] == [3, 7]
+
+
+def test_repo_iterates_records_in_batches_ordered_by_timestamp(repo_path, backend):
+    repo = create_repository(repo_path, backend)
+    repo.add_records(Record(ts, i, "web", "") for i, ts in enumerate([5, 1, 3, 3, 2, 5, 4]))
+    batches = list(repo.iter_record_batches(3))
+    assert [len(b) for b in batches] == [3, 3, 1]
+    assert [r.timestamp for b in batches for r in b] == [1, 2, 3, 3, 4, 5, 5]
+    assert [r for b in batches for r in b] == list(repo.get_all_records())
+    assert tuple(list(create_repository(repo_path, backend).iter_record_batches(7))[0]) == repo.get_all_records()
+
+
+def test_repo_iterating_batches_allows_deleting_each_batch(repo_path, backend):
+    repo = create_repository(repo_path, backend)
+    repo.add_records(Record(i // 2, i, "web", "") for i in range(10))
+    seen = []
+    for batch in repo.iter_record_batches(4):
+        seen.extend(r.metric for r in batch)
+        repo.delete_records(batch)
+    assert seen == list(range(10))
+    assert repo.get_all_records() == ()
+
+
+def test_repo_keeps_publisher_state(repo_path, backend):
+    repo = create_repository(repo_path, backend)
+    assert repo.get('publish_frequency') is None
+    repo['publish_frequency'] = 12.5
+    assert create_repository(repo_path, backend)['publish_frequency'] == 12.5
+
+
+def test_in_memory_repo_drops_oldest_records_when_full(repo_path):
+    repo = InMemoryRepository(repo_path, capacity=3)
+    repo.add_records(Record(i, i, "web", "") for i in range(5))
+    assert [r.metric for r in repo.get_all_records()] == [2, 3, 4]
+
+
+@pytest.fixture
+def mmap_path(repo_path, monkeypatch):
+    monkeypatch.setattr(MmapRepository, '_segments', {})
+    yield str(repo_path) + '.mmap'
+
+
+def test_mmap_repo_recovers_records_and_state_after_restart(mmap_path):
+    repo = MmapRepository(mmap_path, capacity=8)
+    repo.add_records(Record(i, i * 10, "web" if i % 2 else "rq:default", f"m{i}") for i in range(5))
+    repo.delete_records(repo.get_all_records()[:1])
+    repo['last_publish_attempt'] = 1.5
+    repo.close()
+    restarted = MmapRepository(mmap_path, capacity=8)
+    records = restarted.get_all_records()
+    assert [(r.timestamp, r.metric, r.source, r.metadata) for r in records] == [
+        (i, i * 10, "web" if i % 2 else "rq:default", f"m{i}") for i in range(1, 5)
+    ]
+    assert restarted['last_publish_attempt'] == 1.5
+    restarted.add_record(Record(5, 50, "web", ""))
+    assert restarted.get_all_records()[-1].row_id == records[-1].row_id + 1
+
+
+def test_mmap_repo_warns_before_resetting_segment_of_other_capacity(mmap_path, caplog):
+    repo = MmapRepository(mmap_path, capacity=8)
+    repo.add_records(Record(i, i, "web", "") for i in range(3))
+    repo.close()
+    old_size = MMAP_HEADER_SIZE + 8 * MMAP_RECORD_SIZE
+
+    with caplog.at_level(logging.WARNING):
+        resized = MmapRepository(mmap_path, capacity=16)
+    assert f"its size is {old_size} bytes" in caplog.text
+    assert f"needs {MMAP_HEADER_SIZE + 16 * MMAP_RECORD_SIZE} bytes" in caplog.text
+    assert len(resized.get_all_records()) == 0
+
+
+def test_mmap_repo_recovers_records_from_segment_with_corrupted_header(mmap_path):
+    repo = MmapRepository(mmap_path, capacity=8)
+    repo.add_records(Record(i, i, "rq:default", f"m{i}") for i in range(3))
+    repo['last_publish_attempt'] = 1.5
+    repo.close()
+    with open(mmap_path, 'r+b') as f:
+        f.seek(MMAP_HEADER.size)
+        f.write(b'}{')
+
+    restarted = MmapRepository(mmap_path, capacity=8)
+    assert [(r.timestamp, r.metric, r.source, r.metadata) for r in restarted.get_all_records()] == [
+        (i, i, "", f"m{i}") for i in range(3)
+    ]
+    assert 'last_publish_attempt' not in restarted
+    restarted.add_record(Record(3, 3, "web", ""))
+    assert [r.source for r in restarted.get_all_records()] == ["", "", "", "web"]
+
+
+def test_mmap_repo_replaces_oldest_records_when_full(mmap_path):
+    repo = MmapRepository(mmap_path, capacity=3)
+    repo.add_records(Record(i, i, "web", "") for i in range(5))
+    assert [r.metric for r in repo.get_all_records()] == [2, 3, 4]
+
+
+def test_mmap_repo_ignores_corrupted_records(mmap_path):
+    repo = MmapRepository(mmap_path, capacity=4)
+    repo.add_records(Record(i, i, "web", "") for i in range(3))
+    repo._segment.mm[-1] ^= 0xFF  # last slot, record with row id 3
+    repo.close()
+    assert [r.metric for r in MmapRepository(mmap_path, capacity=4).get_all_records()] == [0, 1]
+
+
+def test_mmap_repo_truncates_long_metadata(mmap_path):
+    repo = MmapRepository(mmap_path)
+    repo.add_record(Record(1, 1, "web", "\u00e9" * MMAP_METADATA_SIZE))
+    assert repo.get_all_records()[0].metadata == "\u00e9" * (MMAP_METADATA_SIZE // 2)
+
+
+def test_mmap_repo_falls_back_to_memory_when_another_process_writes(repo_path, mmap_path):
+    with open(mmap_path, 'wb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        assert isinstance(create_repository(repo_path, RepositoryBackend.MMAP), InMemoryRepository)
+
+
+def test_record_batch_stores_records_in_columns():
+    records = [RecordOut(1, 10, "web", "", row_id=1), RecordOut(2, 20, "rq:default", "m", row_id=2),
+               RecordOut(2, 30, "web", "", row_id=3)]
+    batch = RecordBatch.from_records(records)
+    assert (batch.timestamps.typecode, batch.metrics.typecode, batch.row_ids.typecode) == ('q', 'q', 'q')
+    assert batch.sources == ["web", "rq:default"]
+    assert list(batch.source_indexes) == [0, 1, 0]
+    assert list(batch) == records
+    assert batch[1:] == tuple(records[1:])
+    assert list(batch.rows()) == [(r.timestamp, r.metric, r.source, r.metadata) for r in records]
+
+
+def test_records_have_no_instance_dict():
+    assert not hasattr(RecordOut(1, 1, "web", "", row_id=1), '__dict__')
+
+
+def test_repo_creates_partitions_only_for_new_minutes(repo_path):
+    repo = DynoscaleRepository(path=repo_path)
+    statements = []
+    repo.conn.set_trace_callback(statements.append)
+    repo.add_records([Record(1, 1, "web", "")])
+    repo.add_records([Record(2, 2, "web", ""), Record(PARTITION_SECONDS, 3, "web", "")])
+    assert [s.split(' "')[0] for s in statements if s.startswith('CREATE')] == [
+        'CREATE TABLE IF NOT EXISTS', 'CREATE INDEX IF NOT EXISTS',
+        'CREATE TABLE IF NOT EXISTS', 'CREATE INDEX IF NOT EXISTS',
+    ]
+
+
+def test_repo_recreates_partition_dropped_by_another_connection(repo_path):
+    repo = DynoscaleRepository(path=repo_path)
+    repo.add_record(Record(1, 1, "web", ""))
+    other = DynoscaleRepository(path=repo_path)
+    other.delete_records(other.get_all_records())
+    assert partition_tables(repo) == []
+    repo.add_record(Record(2, 2, "web", ""))
+    assert [r.metric for r in other.get_all_records()] == [2]
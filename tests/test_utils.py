@@ -12,7 +12,10 @@ from dynoscale.utils import (
     is_valid_url,
     get_int_from_headers,
     get_int_from_bytestring_headers,
+    get_int_from_environ,
+    get_int_from_asgi_headers,
     ensure_module,
+    Sampler,
 )
 
 logging.basicConfig(level=logging.DEBUG)
@@ -80,6 +83,32 @@ def test_get_int_from_headers_as_dict(key, result, headers, expectation):
             assert get_int_from_headers(key=key, headers=headers) == result
 
 
+@pytest.mark.parametrize(
+    "key, result, environ",
+    [
+        ("HTTP_X_REQUEST_START", None, {}),
+        ("HTTP_X_REQUEST_START", 10, {"HTTP_X_REQUEST_START": "10"}),
+        ("HTTP_X_REQUEST_START", 20, {"HTTP_X_REQUEST_START": 20}),
+        ("HTTP_X_REQUEST_START", 30, {"http_x_request_start": "30"}),
+        ("HTTP_X_REQUEST_START", 40, {"Http_X_Request_Start": "40", "wsgi.input": object()}),
+        ("HTTP_X_REQUEST_START", 50, {"HTTP_X_REQUEST_START": "50", "http_x_request_start": "51"}),
+        ("HTTP_X_REQUEST_START", -1, {"HTTP_X_REQUEST_START": "-1"}),
+        ("HTTP_X_REQUEST_START", None, {"HTTP_X_REQUEST_START": None}),
+        ("HTTP_X_REQUEST_START", None, {"HTTP_X_REQUEST_START": "2.0"}),
+        ("HTTP_X_REQUEST_START", None, {"HTTP_X_REQUEST_START": ""}),
+        ("HTTP_X_REQUEST_START", None, {"HTTP_X_REQUEST_START": b"10"}),
+        ("HTTP_X_REQUEST_START", None, {"HTTP_X_REQUEST_STAR": "10", 1: "10"}),
+    ],
+)
+def test_get_int_from_environ(key, result, environ):
+    assert get_int_from_environ(environ, key) == result
+
+
+def test_get_int_from_environ_returns_default():
+    assert get_int_from_environ({}, "HTTP_X_REQUEST_START", 123) == 123
+    assert get_int_from_environ({"HTTP_X_REQUEST_START": "nope"}, "HTTP_X_REQUEST_START", 123) == 123
+
+
 @pytest.mark.parametrize(
     "key, result, headers, expectation",
     [
@@ -101,6 +130,33 @@ def test_get_int_from_bytestring_headers(key, result, headers, expectation):
             assert get_int_from_bytestring_headers(key=key, headers=headers) == result
 
 
+@pytest.mark.parametrize(
+    "key, result, headers",
+    [
+        (b"x-request-start", None, []),
+        (b"x-request-start", None, {}),
+        (b"x-request-start", 10, [(b"x-request-start", b"10")]),
+        (b"x-request-start", 20, [(b"X-REQUEST-START", b"20")]),
+        (b"x-request-start", 30, [[b"X-Request-Start", b"30"]]),
+        (b"x-request-start", 40, [(b"host", b"localhost"), (b"x-request-start", b"40", b"41")]),
+        (b"x-request-start", 50, [(b"x-request-start", b"50"), (b"x-request-start", b"51")]),
+        (b"x-request-start", -1, [(b"x-request-start", b"-1")]),
+        (b"x-request-start", None, [(b"x-request-start", b"2.0")]),
+        (b"x-request-start", None, [(b"x-request-start", "60")]),
+        (b"x-request-start", None, [(b"x-request-start", 70)]),
+        (b"x-request-start", None, [("x-request-start", b"80")]),
+        (b"x-request-start", None, [(b"x-request-star", b"90"), (b"x-request-start",)]),
+    ],
+)
+def test_get_int_from_asgi_headers(key, result, headers):
+    assert get_int_from_asgi_headers(headers, key) == result
+
+
+def test_get_int_from_asgi_headers_returns_default():
+    assert get_int_from_asgi_headers([], b"x-request-start", 123) == 123
+    assert get_int_from_asgi_headers([(b"x-request-start", b"nope")], b"x-request-start", 123) == 123
+
+
 def test_get_str_from_headers_accepts_list():
     headers = [("key", "val",)]
     s = get_str_from_headers(headers=headers, key="non-existent")
@@ -153,6 +209,22 @@ def test_get_str_from_headers_skips_over_invalid_dict_items():
     assert s == "this"
 
 
+@pytest.mark.parametrize(
+    "n, calls, sampled",
+    [
+        (0, 10, 0),
+        (-1, 10, 0),
+        (1, 10, 10),
+        (3, 10, 3),
+        (10, 10, 1),
+        (11, 10, 0),
+    ]
+)
+def test_sampler_samples_one_in_n_calls(n, calls, sampled):
+    sampler = Sampler(n)
+    assert sum(sampler() for _ in range(calls)) == sampled
+
+
 def test_fake_request_time_ms():
     lo = -5
     up = 5
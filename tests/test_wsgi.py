@@ -88,3 +88,32 @@ def test_dynoscale_wsgi_app_log_queue_time_doesnt_crash_with_invalid_settings(
         assert caplog.record_tuples
         assert len(caplog.record_tuples) == 1
         assert caplog.record_tuples == [('dynoscale.wsgi.DynoscaleWsgiApp', 20, 'Can not calculate queue time.')]
+
+
+def test_dynoscale_wsgi_app_doesnt_format_environ_when_debug_is_disabled(env_valid, app, start_response, caplog):
+    from dynoscale.wsgi import DynoscaleWsgiApp
+
+    class Unprintable(dict):
+        def __repr__(self):
+            raise AssertionError("environ was formatted")
+
+    ds_app = DynoscaleWsgiApp(app)
+    environ = Unprintable(HTTP_X_REQUEST_START="1234123434")
+    with caplog.at_level(logging.INFO):
+        caplog.clear()
+        ds_app.log_queue_time(environ)
+        assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+def test_dynoscale_wsgi_app_traces_sampled_requests(env_valid, monkeypatch, app, environ, start_response, caplog):
+    from dynoscale.constants import ENV_DYNOSCALE_TRACE_SAMPLE_RATE, TRACE_LOGGER_NAME
+    from dynoscale.wsgi import DynoscaleWsgiApp
+    monkeypatch.setenv(ENV_DYNOSCALE_TRACE_SAMPLE_RATE, "3")
+    ds_app = DynoscaleWsgiApp(app)
+    with caplog.at_level(logging.INFO, logger=TRACE_LOGGER_NAME):
+        caplog.clear()
+        for _ in range(7):
+            ds_app(environ, start_response)
+        traces = [r for r in caplog.records if r.name == TRACE_LOGGER_NAME]
+        assert len(traces) == 2
+        assert "HTTP_X_REQUEST_START" in traces[0].getMessage()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import sys
+import timeit
+
+from dynoscale.constants import HTTP_X_REQUEST_START, X_REQUEST_START, X_REQUEST_START_BYTES
+from dynoscale.utils import (
+    get_int_from_headers,
+    get_int_from_environ,
+    get_int_from_bytestring_headers,
+    get_int_from_asgi_headers,
+)
+
+SUB_MICROSECOND_NS = 1_000
+
+
+def print_help():
+    print("Usage: bench_headers.py [number of calls]")
+    print("Measures the per-request cost of reading X-Request-Start from a realistic WSGI environ and ASGI scope.")
+    print("Exits with status 1 if the WSGI fast path costs a microsecond or more per call.")
+
+
+def wsgi_environ() -> dict:
+    environ = {
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'https',
+        'wsgi.input': object(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/api/v1/items',
+        'QUERY_STRING': 'page=2&sort=desc',
+        'SERVER_NAME': 'example.herokuapp.com',
+        'SERVER_PORT': '443',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '10.1.2.3',
+        'HTTP_HOST': 'example.herokuapp.com',
+        'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0',
+        'HTTP_ACCEPT': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'HTTP_ACCEPT_ENCODING': 'gzip, deflate, br',
+        'HTTP_ACCEPT_LANGUAGE': 'en-US,en;q=0.5',
+        'HTTP_COOKIE': '; '.join(f"cookie_{i}={'x' * 64}" for i in range(20)),
+        'HTTP_CONNECTION': 'close',
+        'HTTP_X_FORWARDED_FOR': '203.0.113.7',
+        'HTTP_X_FORWARDED_PROTO': 'https',
+        'HTTP_X_FORWARDED_PORT': '443',
+        'HTTP_X_REQUEST_ID': 'e3b0c442-98fc-1c14-9afb-f4c8996fb924',
+        'HTTP_VIA': '1.1 vegur',
+        'HTTP_CONNECT_TIME': '0',
+        'HTTP_TOTAL_ROUTE_TIME': '0',
+    }
+    environ[HTTP_X_REQUEST_START] = '1686000000000'
+    return environ
+
+
+def asgi_headers() -> list:
+    headers = [
+        (k[5:].lower().replace('_', '-').encode('latin-1'), v.encode('latin-1'))
+        for k, v in wsgi_environ().items() if k.startswith('HTTP_')
+    ]
+    headers += [(f"x-custom-header-{i}".encode('latin-1'), b'value') for i in range(10)]
+    # X-Request-Start is appended by the Heroku router, so it tends to be one of the last headers
+    headers.append(headers.pop(headers.index((X_REQUEST_START_BYTES, b'1686000000000'))))
+    return headers
+
+
+def per_call_ns(stmt, number: int) -> float:
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1_000_000_000
+
+
+if __name__ == '__main__':
+    try:
+        calls: int = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    except ValueError as e:
+        print(f"Error parsing arguments: {e}", file=sys.stderr)
+        print_help()
+        exit(1)
+
+    env = wsgi_environ()
+    generic_ns = per_call_ns(lambda: get_int_from_headers(env, HTTP_X_REQUEST_START), calls)
+    environ_ns = per_call_ns(lambda: get_int_from_environ(env, HTTP_X_REQUEST_START), calls)
+    print(f"get_int_from_headers(environ):  {generic_ns:8.1f} ns/call")
+    print(f"get_int_from_environ(environ):  {environ_ns:8.1f} ns/call ({generic_ns / environ_ns:.1f}x faster)")
+
+    hdrs = asgi_headers()
+    bytestring_ns = per_call_ns(lambda: get_int_from_bytestring_headers(hdrs, X_REQUEST_START), calls)
+    asgi_ns = per_call_ns(lambda: get_int_from_asgi_headers(hdrs, X_REQUEST_START_BYTES), calls)
+    print(f"get_int_from_bytestring_headers({len(hdrs)} headers): {bytestring_ns:8.1f} ns/call")
+    print(f"get_int_from_asgi_headers({len(hdrs)} headers):       {asgi_ns:8.1f} ns/call "
+          f"({bytestring_ns / asgi_ns:.1f}x faster)")
+    exit(0 if environ_ns < SUB_MICROSECOND_NS else 1)